@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+
+class DiskResponseCache:
+    """ Completions stored on disk under their prompt_key(), one file per entry
+        in `<path>/<key[:2]>/<key>`.
+
+        Entries expire `ttl` seconds after they were written and the least
+        recently used ones are deleted once the files add up to more than
+        `max_bytes`. Recency is kept as the file's mtime so it survives a
+        restart, when the index is rebuilt from a directory scan. Several
+        processes can share the directory: a file another process evicted is
+        simply a miss. Methods are thread-safe so callers can run them off the
+        event loop with asyncio.to_thread().
+    """
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> file size, least recently used first
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._scan()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def _scan(self):
+        entries = []
+        if os.path.isdir(self.path):
+            for directory in os.scandir(self.path):
+                if not directory.is_dir():
+                    continue
+                for entry in os.scandir(directory.path):
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._bytes += size
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> Optional[str]:
+        value = self._read(key) if key in self._index else None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._index.move_to_end(key)
+        try:
+            os.utime(self._file(key))
+        except OSError:
+            pass
+        return value
+
+    def _read(self, key: str) -> Optional[str]:
+        try:
+            with open(self._file(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._forget(key)
+            return None
+        if entry['expires_at'] <= time.time():
+            self.delete(key)
+            return None
+        return entry['response']
+
+    def set(self, key: str, response: str, ttl: Optional[float] = None):
+        with self._lock:
+            self._set(key, response, ttl)
+
+    def _set(self, key: str, response: str, ttl: Optional[float]):
+        data = json.dumps({'expires_at': time.time() + (self.ttl if ttl is None else ttl), 'response': response})
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = f"{file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.replace(tmp_file, file)
+
+        self._forget(key)
+        self._index[key] = len(data)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            evicted = next(iter(self._index))
+            self.delete(evicted)
+            self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._forget(key)
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+
+    def _forget(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._bytes -= size
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._index),
+            'bytes': self._bytes,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import AsyncIterator, Callable, Dict, Optional
+
+DEFAULT_MODEL = "gpt-3.5-turbo-1106"
+JSON_RESPONSE = {"type": "json_object"}
+
+
+def prompt_key(model: str, prompt: str, response_format: Optional[Dict], max_tokens: int) -> str:
+    """ Stable hash of everything that determines a completion
+    """
+    payload = json.dumps([model, prompt, response_format, max_tokens], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+#################################################################
+#                          BACKENDS                             #
+#################################################################
+class GenerationBackend:
+    """ Anything that can turn a single user prompt into a completion string.
+        `on_usage(model, prompt_tokens, completion_tokens)` is called when the backend knows its token usage.
+        `on_client_created(name, seconds)` is called when a backend builds its API client on first use.
+    """
+    on_usage: Optional[Callable[[str, int, int], None]] = None
+    on_client_created: Optional[Callable[[str, float], None]] = None
+
+    async def complete(self, model: str, prompt: str, response_format: Optional[Dict], max_tokens: int) -> str:
+        raise NotImplementedError
+
+    async def stream(self, model: str, prompt: str, response_format: Optional[Dict], max_tokens: int) -> AsyncIterator[str]:
+        """ Pieces of the completion as they are generated. Backends that cannot stream yield it whole.
+        """
+        yield await self.complete(model, prompt, response_format, max_tokens)
+
+
+class OpenAIBackend(GenerationBackend):
+    """ The openai package and its client are only loaded on the first completion,
+        processes that never generate anything do not pay for the import.
+    """
+    def __init__(self, api_key: Optional[str] = None, max_retries: int = 2):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            start = time.perf_counter()
+            # Imported here so the fake backend works without the openai package
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(api_key=self.api_key, max_retries=self.max_retries)
+            if self.on_client_created is not None:
+                self.on_client_created('openai client', time.perf_counter() - start)
+        return self._client
+
+    async def complete(self, model, prompt, response_format, max_tokens):
+        kwargs = {}
+        if response_format:
+            kwargs['response_format'] = response_format
+        chat_completion = await self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            **kwargs
+        )
+        if self.on_usage is not None and chat_completion.usage is not None:
+            self.on_usage(model, chat_completion.usage.prompt_tokens, chat_completion.usage.completion_tokens)
+        return chat_completion.choices[0].message.content
+
+    async def stream(self, model, prompt, response_format, max_tokens):
+        kwargs = {}
+        if response_format:
+            kwargs['response_format'] = response_format
+        # Streamed responses do not report token usage
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            stream=True,
+            **kwargs
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class FakeBackend(GenerationBackend):
+    """ Local stand-in for the model. Sleeps for `latency` seconds and returns
+        whatever `responder(prompt)` returns (a canned JSON post by default).
+    """
+    def __init__(self, latency: float = 0.0, responder: Optional[Callable[[str], str]] = None):
+        self.latency = latency
+        self.responder = responder
+        self.calls = 0
+
+    async def complete(self, model, prompt, response_format, max_tokens):
+        self.calls += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        if self.responder is not None:
+            return self.responder(prompt)
+        return json.dumps({"post": f"Sample post #{self.calls}"})
+
+    async def stream(self, model, prompt, response_format, max_tokens):
+        """ The response word by word, with `latency` spread over the words """
+        self.calls += 1
+        response = self.responder(prompt) if self.responder is not None else f"Sample post #{self.calls}"
+        words = response.split(' ')
+        for index, word in enumerate(words):
+            if self.latency > 0:
+                await asyncio.sleep(self.latency / len(words))
+            yield word if index == 0 else f" {word}"
+
+
+def make_backend(name: str, api_key: Optional[str] = None, fake_latency: float = 0.0) -> GenerationBackend:
+    if name == 'openai':
+        return OpenAIBackend(api_key)
+    if name == 'fake':
+        return FakeBackend(latency=fake_latency)
+    raise ValueError(f"Unknown AI backend: {name}")
+
+
+#################################################################
+#                           CLIENT                              #
+#################################################################
+class AIClient:
+    """ Async front for a generation backend.
+
+        - At most `max_in_flight` completions run at once, the rest wait their turn.
+        - Every call is bounded by `timeout` seconds (queueing included) and raises
+          asyncio.TimeoutError when exceeded.
+        - Identical prompts that are already in flight share a single completion.
+        - With a `cache` (ai.cache.DiskResponseCache) completions are stored under
+          their prompt_key() and reused. JSON completions are only stored when they parse.
+        - use_cache=False skips both the cache and the sharing of in-flight completions.
+    """
+    def __init__(self, backend: GenerationBackend, max_in_flight: int = 8, timeout: float = 30.0, cache=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.cache = cache
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'coalesced': self.coalesced}
+
+    async def send_prompt(self, prompt: str, model: str = DEFAULT_MODEL, response_format: Optional[Dict] = JSON_RESPONSE,
+                          max_tokens: int = 1000, timeout: Optional[float] = None, use_cache: bool = True) -> str:
+        timeout = self.timeout if timeout is None else timeout
+        if not use_cache:
+            # Callers asking for a fresh result want a completion of their own, not a shared one
+            return await asyncio.wait_for(self._complete(model, prompt, response_format, max_tokens), timeout)
+
+        key = prompt_key(model, prompt, response_format, max_tokens)
+        if self.cache is not None:
+            # The cache reads and touches files, keep that off the event loop
+            response = await asyncio.to_thread(self.cache.get, key)
+            if response is not None:
+                return response
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(asyncio.wait_for(
+                self._complete(model, prompt, response_format, max_tokens, key if self.cache is not None else None), timeout))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        # Shielded so one waiter giving up does not cancel the completion for the others
+        return await asyncio.shield(task)
+
+    async def stream_prompt(self, prompt: str, model: str = DEFAULT_MODEL, response_format: Optional[Dict] = None,
+                            max_tokens: int = 1000, timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """ Like send_prompt() but yields the completion as it is generated. Streams hold a
+            `max_in_flight` slot until they finish and are neither coalesced nor cached.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.timeout if timeout is None else timeout)
+        await asyncio.wait_for(self._semaphore.acquire(), deadline - loop.time())
+        chunks = self.backend.stream(model, prompt, response_format, max_tokens)
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        finally:
+            self._semaphore.release()
+            await chunks.aclose()
+
+    def _forget(self, key: str, task: asyncio.Future):
+        self._in_flight.pop(key, None)
+        # Mark the exception as retrieved in case every waiter already gave up
+        if not task.cancelled():
+            task.exception()
+
+    async def _complete(self, model, prompt, response_format, max_tokens, cache_key=None) -> str:
+        async with self._semaphore:
+            response = await self.backend.complete(model, prompt, response_format, max_tokens)
+        if cache_key is not None and self._cacheable(response, response_format):
+            try:
+                await asyncio.to_thread(self.cache.set, cache_key, response)
+            except OSError as e:
+                print(f"An error occured: {e}")
+        return response
+
+    @staticmethod
+    def _cacheable(response, response_format) -> bool:
+        if not isinstance(response, str):
+            return False
+        if response_format == JSON_RESPONSE:
+            try:
+                json.loads(response)
+            except ValueError:
+                return False
+        return True
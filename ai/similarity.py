@@ -0,0 +1,133 @@
+import hashlib
+import re
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+WORD_REGEX = re.compile(r"[#$@]?\w+")
+# Below this many stored posts a plain loop beats the fixed cost of a dozen numpy calls
+SMALL_INDEX = 64
+
+_M1, _M2, _M4, _H01 = (np.uint64(mask) for mask in (0x5555555555555555, 0x3333333333333333,
+                                                    0x0F0F0F0F0F0F0F0F, 0x0101010101010101))
+_S1, _S2, _S4, _S56 = (np.uint64(shift) for shift in (1, 2, 4, 56))
+_BIT_WEIGHTS = (1 << np.arange(64, dtype=np.uint64)).astype(np.uint64)
+
+
+def _features(text: str) -> List[str]:
+    """ Lowercased words, tags and handles. Punctuation and emphasis do not change the hash. """
+    return WORD_REGEX.findall(text.lower())
+
+
+def simhash(text: str) -> int:
+    """ 64-bit SimHash of a post. Near-identical posts differ in only a few bits.
+    """
+    features = _features(text)
+    if not features:
+        return 0
+    hashes = np.array([int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+                       for feature in features], dtype=np.uint64)
+    # One row of 64 bits per feature, each bit votes +1 or -1
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    votes = bits.sum(axis=0, dtype=np.int32) * 2 - len(features)
+    return int(_BIT_WEIGHTS[votes > 0].sum(dtype=np.uint64))
+
+
+def hamming_distances(signatures: np.ndarray, signature: int, out: Optional[np.ndarray] = None,
+                      scratch: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Bits differing between `signature` and each stored signature. Passing `out`
+        and `scratch` buffers of the same length avoids allocating per lookup.
+    """
+    out = np.empty_like(signatures) if out is None else out
+    np.bitwise_xor(signatures, np.uint64(signature), out=out)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(out, out=out)
+
+    # numpy < 2.0 has no popcount, count the bits of each uint64 in parallel (SWAR) instead
+    scratch = np.empty_like(signatures) if scratch is None else scratch
+    np.right_shift(out, _S1, out=scratch)
+    np.bitwise_and(scratch, _M1, out=scratch)
+    np.subtract(out, scratch, out=out)
+    np.right_shift(out, _S2, out=scratch)
+    np.bitwise_and(scratch, _M2, out=scratch)
+    np.bitwise_and(out, _M2, out=out)
+    np.add(out, scratch, out=out)
+    np.right_shift(out, _S4, out=scratch)
+    np.add(out, scratch, out=out)
+    np.bitwise_and(out, _M4, out=out)
+    np.multiply(out, _H01, out=out)
+    return np.right_shift(out, _S56, out=out)
+
+
+class SimHashIndex:
+    """ SimHash signatures of the posts generated per key (a project's group chat),
+        kept in one packed uint64 array each so a lookup is a single vectorised
+        XOR and popcount over every stored post.
+
+        A post is a near-duplicate when its signature is at most `threshold`
+        bits away from a stored one. Keys beyond `max_keys` are evicted least
+        recently used first.
+    """
+    def __init__(self, threshold: int = 10, max_keys: int = 1000):
+        self.threshold = threshold
+        self.max_keys = max_keys
+        # key -> [signatures (grown by doubling), number in use]
+        self._signatures: "OrderedDict[object, list]" = OrderedDict()
+        # Reused by every lookup, grown with the largest key
+        self._out = np.empty(0, dtype=np.uint64)
+        self._scratch = np.empty(0, dtype=np.uint64)
+        self.checked = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return sum(count for _, count in self._signatures.values())
+
+    def _entry(self, key) -> list:
+        entry = self._signatures.get(key)
+        if entry is None:
+            entry = self._signatures[key] = [np.empty(64, dtype=np.uint64), 0]
+            while len(self._signatures) > self.max_keys:
+                self._signatures.popitem(last=False)
+        self._signatures.move_to_end(key)
+        return entry
+
+    def nearest(self, key, signature: int) -> Optional[int]:
+        """ Smallest Hamming distance to a stored signature, None if nothing is stored
+        """
+        signatures, count = self._entry(key)
+        if not count:
+            return None
+        if count <= SMALL_INDEX:
+            return min((stored ^ signature).bit_count() for stored in signatures[:count].tolist())
+        if len(self._out) < count:
+            self._out = np.empty(len(signatures), dtype=np.uint64)
+            self._scratch = np.empty(len(signatures), dtype=np.uint64)
+        return int(hamming_distances(signatures[:count], signature, self._out[:count], self._scratch[:count]).min())
+
+    def add(self, key, signature: int):
+        entry = self._entry(key)
+        signatures, count = entry
+        if count == len(signatures):
+            signatures = entry[0] = np.concatenate([signatures, np.empty(len(signatures), dtype=np.uint64)])
+        signatures[count] = signature
+        entry[1] = count + 1
+
+    def add_if_unique(self, key, text: str) -> bool:
+        """ Store the post unless it is a near-duplicate of one already stored. Returns whether it was stored.
+        """
+        signature = simhash(text)
+        distance = self.nearest(key, signature)
+        self.checked += 1
+        if distance is not None and distance <= self.threshold:
+            self.rejected += 1
+            return False
+        self.add(key, signature)
+        return True
+
+    def extend(self, key, texts: Iterable[str]):
+        for text in texts:
+            self.add(key, simhash(text))
+
+    def stats(self) -> Dict[str, int]:
+        return {'keys': len(self._signatures), 'posts': len(self), 'checked': self.checked, 'rejected': self.rejected}
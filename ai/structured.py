@@ -0,0 +1,66 @@
+import json
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+
+class IncompleteGenerationError(ValueError):
+    """ Raised when the retry or token budget runs out before every key is valid.
+        `partial` holds the keys that were generated so a later call can skip them.
+    """
+    def __init__(self, missing: List[str], partial: Dict[str, str]):
+        super().__init__(f"Could not generate descriptions for: {', '.join(missing)}. Please try again.")
+        self.missing = missing
+        self.partial = partial
+
+
+def invalid_keys(data: Dict, keys: Iterable[str], max_words: int) -> List[str]:
+    """ Keys that are missing, empty, not a string or longer than `max_words` words
+    """
+    return [key for key in keys
+            if not isinstance(data.get(key), str) or not data[key].strip() or len(data[key].split()) > max_words]
+
+
+async def generate_fields(send_prompt: Callable[..., Awaitable[str]], build_prompt: Callable[[List[str]], str],
+                          keys: Iterable[str], known: Optional[Dict[str, str]] = None, max_words: int = 30,
+                          max_attempts: int = 3, tokens_per_key: int = 60, max_total_tokens: int = 2000) -> Dict[str, str]:
+    """ Ask the model for a JSON object with one string per key.
+
+        Valid values from `known` and from earlier attempts are kept, and each
+        retry only asks for the keys still missing or over-length, with
+        max_tokens sized to those keys. Stops after `max_attempts` calls or once
+        the next call would exceed `max_total_tokens`. A retry with the same
+        prompt as an earlier attempt passes use_cache=False to `send_prompt` so
+        it is not answered with the cached completion that just failed.
+    """
+    keys = list(keys)
+    result = {key: value for key, value in (known or {}).items() if key in keys}
+    result = {key: result[key] for key in keys if key in result and not invalid_keys(result, [key], max_words)}
+    missing = [key for key in keys if key not in result]
+    tokens_left = max_total_tokens
+    sent = set()
+
+    for _ in range(max_attempts):
+        if not missing:
+            break
+        max_tokens = tokens_per_key * len(missing) + 50
+        if max_tokens > tokens_left:
+            break
+        tokens_left -= max_tokens
+
+        prompt = build_prompt(missing)
+        response = await send_prompt(prompt, max_tokens=max_tokens, use_cache=(prompt, max_tokens) not in sent)
+        sent.add((prompt, max_tokens))
+        try:
+            data = json.loads(response)
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(data, dict):
+            continue
+
+        for key in missing:
+            if not invalid_keys(data, [key], max_words):
+                result[key] = data[key].strip()
+        missing = [key for key in keys if key not in result]
+
+    if missing:
+        raise IncompleteGenerationError(missing, result)
+    return {key: result[key] for key in keys}
@@ -0,0 +1,50 @@
+""" Encode/decode cost of db.schemas codecs against dataclasses.asdict.
+
+    python -m bench.codec_bench
+"""
+import timeit
+from dataclasses import asdict, fields
+
+from bson.objectid import ObjectId
+
+from db.schemas import Project, ShillgenXTarget, project_codec, target_codec
+
+ROUNDS = 100000
+
+
+def asdict_encode(obj):
+    doc = asdict(obj)
+    del doc['_id']
+    return doc
+
+
+def constructor_decode(cls, doc):
+    # Stored documents carry extra keys (e.g. unlock_at), which the constructor would reject
+    names = {f.name for f in fields(cls)}
+    return cls(**{key: value for key, value in doc.items() if key in names})
+
+
+def main():
+    project = Project(group_chat_id=-1001234567890, name="Bench Project", description="A project used to benchmark the codec.",
+                      x_handle="@bench", telegram="https://t.me/+bench", website="www.example.com", tags=["$BENCH", "#bench"],
+                      topics={key: f"A twenty word description of the {key} of the project." for key in Project().topics})
+    target = ShillgenXTarget(project_id=ObjectId(), group_chat_id=-1001234567890, x_target_link="https://x.com/bench/status/1",
+                             lock_duration=5)
+    project_doc = {**project_codec.encode(project), '_id': ObjectId()}
+    target_doc = {**target_codec.encode(target), '_id': ObjectId(), 'unlock_at': None}
+
+    cases = [
+        ("Project encode", lambda: asdict_encode(project), lambda: project_codec.encode(project)),
+        ("Project decode", lambda: constructor_decode(Project, project_doc), lambda: project_codec.decode(project_doc)),
+        ("ShillgenXTarget encode", lambda: asdict_encode(target), lambda: target_codec.encode(target)),
+        ("ShillgenXTarget decode", lambda: constructor_decode(ShillgenXTarget, target_doc), lambda: target_codec.decode(target_doc)),
+    ]
+    print(f"{'case':<24} {'asdict/ctor us':>15} {'codec us':>10} {'speedup':>8}")
+    for name, baseline, codec in cases:
+        baseline_time = min(timeit.repeat(baseline, number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+        codec_time = min(timeit.repeat(codec, number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+        print(f"{name:<24} {baseline_time:>15.2f} {codec_time:>10.2f} {baseline_time / codec_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
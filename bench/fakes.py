@@ -0,0 +1,349 @@
+""" In-process stand-ins for the Telegram Bot API, the Motor database and the
+    model, each with configurable latency, used by the benchmarks.
+"""
+import asyncio
+import copy
+import itertools
+import json
+import random
+import re
+from types import SimpleNamespace
+from typing import Dict, List
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+
+async def delay(latency: float, jitter: float = 0.0):
+    if latency > 0 or jitter > 0:
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+
+#################################################################
+#                          TELEGRAM                             #
+#################################################################
+class FakeBot:
+    """ Implements the AsyncTeleBot API calls the handlers make.
+        `admins[chat_id]` lists the user IDs reported as that chat's administrators and
+        `deep_links[chat_id]` keeps the last /start payload the bot sent to the chat.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.message_ids = itertools.count(1)
+        self.calls: Dict[str, int] = {}
+        self.admins: Dict[int, List[int]] = {}
+        self.deep_links: Dict[int, str] = {}
+
+    async def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await delay(self.latency, self.jitter)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call('send_message')
+        if '?start=' in text:
+            self.deep_links[chat_id] = text.split('?start=', 1)[1].split()[0]
+        return SimpleNamespace(message_id=next(self.message_ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._call('edit_message_text')
+        return SimpleNamespace(message_id=message_id, chat=SimpleNamespace(id=chat_id), text=text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call('delete_message')
+        return True
+
+    async def set_chat_permissions(self, chat_id, permissions, **kwargs):
+        await self._call('set_chat_permissions')
+        return True
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        await self._call('answer_callback_query')
+        return True
+
+    async def get_chat_administrators(self, chat_id):
+        await self._call('get_chat_administrators')
+        return [SimpleNamespace(user=SimpleNamespace(id=user_id), status='administrator')
+                for user_id in self.admins.get(chat_id, [])]
+
+    async def export_chat_invite_link(self, chat_id):
+        await self._call('export_chat_invite_link')
+        return f"https://t.me/+bench{abs(chat_id)}"
+
+
+#################################################################
+#                            MONGO                              #
+#################################################################
+def _parent(doc: Dict, field: str, create: bool = False):
+    """ (dict holding the last part of a dotted field, last part) """
+    *parents, last = field.split('.')
+    for part in parents:
+        if part not in doc:
+            if not create:
+                return {}, last
+            doc[part] = {}
+        doc = doc[part]
+    return doc, last
+
+
+def _matches(doc: Dict, query: Dict) -> bool:
+    for field, condition in query.items():
+        parent, key = _parent(doc, field)
+        value = parent.get(key)
+        if isinstance(condition, dict) and any(operator.startswith('$') for operator in condition):
+            for operator, operand in condition.items():
+                if operator == '$exists' and (key in parent) != operand:
+                    return False
+                if operator == '$in' and value not in operand:
+                    return False
+                if operator == '$ne' and value == operand:
+                    return False
+                if operator == '$lt' and not (value is not None and value < operand):
+                    return False
+                if operator == '$gte' and not (value is not None and value >= operand):
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _apply(doc: Dict, update: Dict):
+    for field, value in update.get('$set', {}).items():
+        parent, key = _parent(doc, field, create=True)
+        parent[key] = value
+    for field in update.get('$unset', {}):
+        parent, key = _parent(doc, field)
+        parent.pop(key, None)
+    for field, value in update.get('$inc', {}).items():
+        parent, key = _parent(doc, field, create=True)
+        parent[key] = parent.get(key, 0) + value
+    for field, value in update.get('$setOnInsert', {}).items():
+        doc.setdefault(field, value)
+
+
+class FakeCursor:
+    def __init__(self, docs: List[Dict], latency: float, jitter: float):
+        self.docs = docs
+        self.latency = latency
+        self.jitter = jitter
+
+    def limit(self, count: int):
+        if count:
+            self.docs = self.docs[:count]
+        return self
+
+    def sort(self, key, direction=1):
+        self.docs = sorted(self.docs, key=lambda doc: doc.get(key), reverse=direction < 0)
+        return self
+
+    def batch_size(self, size: int):
+        return self
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        await delay(self.latency, self.jitter)
+        for doc in self.docs:
+            yield doc
+
+    async def to_list(self, length=None):
+        await delay(self.latency, self.jitter)
+        return self.docs if length is None else self.docs[:length]
+
+
+class FakeCollection:
+    """ Enough of Motor's AsyncIOMotorCollection for the bot. Queries support
+        equality plus $exists, $in, $ne, $lt and $gte, updates $set, $unset and $inc
+        (dotted fields included) and bulk_write takes UpdateOne requests.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, name: str = ''):
+        self.latency = latency
+        self.jitter = jitter
+        self.name = name
+        self.docs: Dict[ObjectId, Dict] = {}
+        self.indexes = set()
+        # Values already taken for each field under a unique index
+        self.unique_values: Dict[str, set] = {}
+
+    async def _round_trip(self):
+        await delay(self.latency, self.jitter)
+
+    def _insert(self, doc: Dict):
+        if doc.get('_id') in self.docs:
+            raise DuplicateKeyError("E11000 duplicate key error _id")
+        for field, values in self.unique_values.items():
+            if doc.get(field) in values:
+                raise DuplicateKeyError(f"E11000 duplicate key error {field}")
+        for field, values in self.unique_values.items():
+            values.add(doc.get(field))
+        doc.setdefault('_id', ObjectId())
+        self.docs[doc['_id']] = doc
+
+    def _remove(self, doc: Dict):
+        for field, values in self.unique_values.items():
+            values.discard(doc.get(field))
+        del self.docs[doc['_id']]
+
+    def _first(self, query: Dict):
+        if '_id' in query and not isinstance(query['_id'], dict):
+            doc = self.docs.get(query['_id'])
+            return doc if doc is not None and _matches(doc, query) else None
+        return next((doc for doc in self.docs.values() if _matches(doc, query)), None)
+
+    async def index_information(self):
+        return {name: {} for name in self.indexes}
+
+    async def create_index(self, keys, name: str = '', **kwargs):
+        self.indexes.add(name)
+        return name
+
+    async def drop_index(self, name: str):
+        self.indexes.discard(name)
+
+    async def create_indexes(self, models):
+        await self._round_trip()
+        for model in models:
+            document = model.document
+            if document.get('unique'):
+                for field in document['key'].keys():
+                    self.unique_values[field] = {doc.get(field) for doc in self.docs.values()}
+
+    async def insert_one(self, doc: Dict):
+        await self._round_trip()
+        self._insert(doc)
+        return SimpleNamespace(inserted_id=doc['_id'])
+
+    async def insert_many(self, docs: List[Dict], ordered: bool = True):
+        await self._round_trip()
+        for doc in docs:
+            self._insert(doc)
+        return SimpleNamespace(inserted_ids=[doc['_id'] for doc in docs])
+
+    async def find_one(self, query: Dict, projection=None):
+        await self._round_trip()
+        return self._first(query)
+
+    async def count_documents(self, query: Dict):
+        await self._round_trip()
+        return sum(1 for doc in self.docs.values() if _matches(doc, query))
+
+    def find(self, query: Dict = None, projection=None, **kwargs) -> FakeCursor:
+        return FakeCursor([doc for doc in self.docs.values() if _matches(doc, query or {})], self.latency, self.jitter)
+
+    async def update_one(self, query: Dict, update: Dict, upsert: bool = False):
+        await self._round_trip()
+        doc = self._first(query)
+        if doc is None and upsert:
+            doc = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            self._insert(doc)
+        if doc is not None:
+            _apply(doc, update)
+        return SimpleNamespace(matched_count=int(doc is not None), modified_count=int(doc is not None))
+
+    async def find_one_and_update(self, query: Dict, update: Dict, projection=None, return_document: bool = False):
+        await self._round_trip()
+        doc = self._first(query)
+        if doc is None:
+            return None
+        before = copy.deepcopy(doc)
+        _apply(doc, update)
+        return copy.deepcopy(doc) if return_document else before
+
+    async def update_many(self, query: Dict, update: Dict):
+        await self._round_trip()
+        matched = [doc for doc in self.docs.values() if _matches(doc, query)]
+        for doc in matched:
+            _apply(doc, update)
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched))
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        await self._round_trip()
+        for request in requests:
+            doc = self._first(request._filter)
+            if doc is not None:
+                _apply(doc, request._doc)
+        return SimpleNamespace(matched_count=len(requests), modified_count=len(requests))
+
+    async def delete_one(self, query: Dict):
+        await self._round_trip()
+        doc = self._first(query)
+        if doc is not None:
+            self._remove(doc)
+        return SimpleNamespace(deleted_count=int(doc is not None))
+
+    async def delete_many(self, query: Dict):
+        await self._round_trip()
+        matched = [doc for doc in self.docs.values() if _matches(doc, query)]
+        for doc in matched:
+            self._remove(doc)
+        return SimpleNamespace(deleted_count=len(matched))
+
+    async def drop(self):
+        await self._round_trip()
+        self.docs.clear()
+        for values in self.unique_values.values():
+            values.clear()
+
+
+class FakeDatabase:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = FakeCollection(self.latency, self.jitter, name)
+        return collection
+
+
+#################################################################
+#                            MODEL                              #
+#################################################################
+JSON_KEYS = re.compile(r'JSON keys: (.+)$', re.DOTALL)
+POST_WORDS = [f"word{i}" for i in range(200)]
+
+
+def fake_responder(prompt: str) -> str:
+    """ Topic descriptions for the setup prompt, a single post for anything else
+    """
+    match = JSON_KEYS.search(prompt)
+    if match:
+        keys = [key.strip() for key in match.group(1).split(',')]
+        return json.dumps({key: f"A short benchmark description of the project's {key} that stays within the limit." for key in keys})
+    # Varied enough not to be rejected as near-duplicates by the post pool
+    return json.dumps({"post": f"{' '.join(random.sample(POST_WORDS, 10))} $BENCH #bench"})
+
+
+#################################################################
+#                           WIRING                              #
+#################################################################
+def install_fakes(app, bot: FakeBot, database: FakeDatabase, ai_latency: float = 0.0, rate_limited: bool = False):
+    """ Point an imported shillgenx module at the fakes. Everything the module
+        built around the real clients at import time is rebuilt around the fakes.
+    """
+    from ai.client import AIClient, FakeBackend
+    from tg.sender import SendQueue
+    from tg.scheduler import MongoLockStore
+
+    for name in ('send_message', 'edit_message_text', 'delete_message', 'set_chat_permissions',
+                 'answer_callback_query', 'get_chat_administrators', 'export_chat_invite_link'):
+        setattr(app.bot, name, getattr(bot, name))
+
+    app.db = database
+    app.lock_scheduler.store = MongoLockStore(database["target"])
+    app.post_pool.collection = database["post"]
+    app.post_pool.leases = database["post_refill"]
+    app.goal_tracker.collection = database["target"]
+    app.archiver.targets = database["target"]
+    app.archiver.posts = database["post"]
+    # No response cache: every run should pay for its completions
+    app.ai_client = AIClient(FakeBackend(latency=ai_latency, responder=fake_responder),
+                             max_in_flight=app.AI_MAX_IN_FLIGHT, timeout=app.AI_TIMEOUT)
+    if rate_limited:
+        app.sender = SendQueue(bot.send_message, global_rate=app.TG_GLOBAL_RATE,
+                               private_rate=app.TG_PRIVATE_CHAT_RATE, group_rate=app.TG_GROUP_CHAT_RATE)
+    else:
+        app.sender = SendQueue(bot.send_message, global_rate=1e9, private_rate=1e9, group_rate=1e9, burst=1e9)
@@ -0,0 +1,198 @@
+""" Handler throughput benchmark.
+
+    Runs the /sgx_setup -> process_tags and /shillx -> process_duration flows for
+    many simulated group chats through the real handlers and pyTelegramBotAPI
+    dispatch, then has raiders open the deep link. Telegram, Mongo and the model
+    are in-process fakes with injectable latency. Reports updates/s and p50/p99
+    latency per handler and compares them against a stored baseline.
+
+    Baselines depend on the machine, so none is committed: save one on the
+    reference machine first. A run without a baseline for its settings warns,
+    or fails with --require-baseline.
+
+    python -m bench.handlers --chats 2000 --tg-latency 0.05 --db-latency 0.002 --ai-latency 1.5
+    python -m bench.handlers --chats 2000 --save-baseline
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+from bench.fakes import FakeBot, FakeDatabase, install_fakes
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baselines', 'handlers.json')
+
+# Step name -> text the admin sends, in order
+SETUP_STEPS = [
+    ('sgx_setup', '/sgx_setup'),
+    ('process_project_name', 'Bench Project'),
+    ('process_project_description', 'A benchmark project that exists to measure how fast the bot answers.'),
+    ('process_x_handle', '@benchproject'),
+    ('process_website', 'www.example.com'),
+    ('process_tags', '$BENCH #bench'),
+]
+RAID_STEPS = [
+    ('shillx', '/shillx'),
+    ('process_x_target_link', 'https://x.com/bench/status/1'),
+    ('process_duration', '5'),
+]
+
+
+def configure_environment():
+    """ shillgenx reads its configuration at import time """
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '0:bench')
+    os.environ.setdefault('MONGO_USERNAME', 'bench')
+    os.environ.setdefault('MONGO_PASSWORD', 'bench')
+    os.environ.setdefault('MONGO_HOST', 'localhost')
+    os.environ.setdefault('MONGO_PORT', '27017')
+    os.environ.setdefault('MONGO_DB', 'bench')
+    os.environ['AI_BACKEND'] = 'fake'
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+class Driver:
+    def __init__(self, app, fake_bot: FakeBot):
+        self.app = app
+        self.fake_bot = fake_bot
+        self.update_ids = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = {}
+
+    def make_update(self, chat_id: int, chat_type: str, user_id: int, text: str):
+        return self.app.types.Update.de_json({
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': next(self.update_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': chat_type},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+                'text': text,
+            },
+        })
+
+    async def send(self, step: str, chat_id: int, chat_type: str, user_id: int, text: str):
+        update = self.make_update(chat_id, chat_type, user_id, text)
+        start = time.perf_counter()
+        await self.app.bot.process_new_updates([update])
+        self.latencies.setdefault(step, []).append(time.perf_counter() - start)
+
+    async def run_chat(self, index: int, raiders: int):
+        chat_id = -1000000000000 - index
+        admin_id = index + 1
+        self.fake_bot.admins[chat_id] = [admin_id]
+
+        for step, text in SETUP_STEPS + RAID_STEPS:
+            await self.send(step, chat_id, 'supergroup', admin_id, text)
+
+        payload = self.fake_bot.deep_links.get(chat_id)
+        if payload is None:
+            return
+        await asyncio.gather(*(self.send('handle_start', raider_id, 'private', raider_id, f"/start {payload}")
+                               for raider_id in range(10000000 + index * raiders, 10000000 + (index + 1) * raiders)))
+
+
+async def run(args) -> Dict:
+    configure_environment()
+    import shillgenx as app
+
+    fake_bot = FakeBot(args.tg_latency, args.jitter)
+    install_fakes(app, fake_bot, FakeDatabase(args.db_latency, args.jitter), args.ai_latency, args.rate_limited)
+    await app.ensure_indexes(app.db)
+    driver = Driver(app, fake_bot)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def chat(index):
+        async with semaphore:
+            await driver.run_chat(index, args.raiders)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(index) for index in range(args.chats)))
+    elapsed = time.perf_counter() - start
+
+    updates = sum(len(values) for values in driver.latencies.values())
+    return {
+        'scenario': {key: getattr(args, key) for key in ('chats', 'raiders', 'concurrency', 'tg_latency', 'db_latency',
+                                                          'ai_latency', 'jitter', 'rate_limited')},
+        'updates': updates,
+        'seconds': elapsed,
+        'updates_per_second': updates / elapsed if elapsed else 0.0,
+        'handlers': {step: {'count': len(values), 'p50_ms': percentile(values, 0.5) * 1000,
+                            'p99_ms': percentile(values, 0.99) * 1000}
+                     for step, values in driver.latencies.items()},
+    }
+
+
+def report(result: Dict, baseline: Dict, tolerance: float) -> bool:
+    """ Print the result next to the baseline. Returns False on a regression beyond `tolerance`.
+    """
+    ok = True
+    print(f"{result['updates']} updates in {result['seconds']:.2f}s = {result['updates_per_second']:.0f} updates/s")
+    if baseline:
+        base_rate = baseline['updates_per_second']
+        change = result['updates_per_second'] / base_rate - 1 if base_rate else 0.0
+        flag = ''
+        if change < -tolerance:
+            flag, ok = '  REGRESSION', False
+        print(f"baseline {base_rate:.0f} updates/s ({change:+.0%}){flag}")
+
+    print(f"{'handler':<30} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'baseline p99':>13}")
+    for step, stats in result['handlers'].items():
+        line = f"{step:<30} {stats['count']:>7} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f}"
+        base = baseline.get('handlers', {}).get(step) if baseline else None
+        if base:
+            line += f" {base['p99_ms']:>13.2f}"
+            if base['p99_ms'] and stats['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+                line += '  REGRESSION'
+                ok = False
+        print(line)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--raiders', type=int, default=5, help="deep link opens per raid")
+    parser.add_argument('--concurrency', type=int, default=500, help="chats running their flows at once")
+    parser.add_argument('--tg-latency', type=float, default=0.0)
+    parser.add_argument('--db-latency', type=float, default=0.0)
+    parser.add_argument('--ai-latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rate-limited', action='store_true', help="keep Telegram's rate limits in the send queue")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against the baseline")
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--require-baseline', action='store_true', help="fail when there is no baseline to compare against")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baselines = json.load(f)
+    key = json.dumps(result['scenario'], sort_keys=True)
+    ok = report(result, baselines.get(key), args.tolerance)
+    if key not in baselines and not args.save_baseline:
+        print(f"WARNING: no baseline for these settings in {BASELINE_PATH}, nothing was compared. "
+              f"Save one with --save-baseline on the reference machine.", file=sys.stderr)
+        ok = ok and not args.require_baseline
+
+    if args.save_baseline:
+        baselines[key] = result
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {BASELINE_PATH}")
+    elif not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+""" Replays recorded updates (see tg.recorder, RECORD_UPDATES_PATH) through the
+    real handlers and pyTelegramBotAPI dispatch, against the fakes.
+
+    Updates are handed to the bot when they fall due at their recorded pace
+    sped up --speed times, and their latency is measured from that due time
+    to the end of their handling, so a bot that falls behind shows it as
+    latency. Idle gaps longer than --max-gap seconds are shortened.
+
+    A recorded /start refers to the group whose link was opened. It is sent
+    with the last link this run posted to that group, once there is one:
+    raiders cannot open a link that was not sent yet, so the wait for it (at
+    most --link-wait seconds) counts towards the /start's latency.
+
+    Given several speeds, each one runs in a fresh process with empty fakes.
+    The saturation point is the first speed at which the p99 latency goes
+    over --slo seconds or updates are turned away as busy.
+
+    python -m bench.replay updates.jsonl --speed 1
+    python -m bench.replay updates.jsonl.0 updates.jsonl.1 --speed 1,2,5,10,20,50 --tg-latency 0.05 --db-latency 0.002
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from bench.fakes import FakeBot, FakeDatabase, install_fakes
+from bench.handlers import configure_environment, percentile
+from tg.recorder import START_REFERENCE
+
+# Commands that check for an admin. Whoever sent them in a group is reported as one of its admins.
+ADMIN_COMMANDS = ('/sgx_', '/shillx')
+
+
+def load(paths: List[str], max_gap: float) -> List[Tuple[float, Dict]]:
+    """ (seconds from the first update, raw update) of every recording, in order
+    """
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record['t'])
+
+    schedule = []
+    offset = 0.0
+    previous = records[0]['t'] if records else 0.0
+    for record in records:
+        offset += min(record['t'] - previous, max_gap)
+        previous = record['t']
+        schedule.append((offset, record['update']))
+    return schedule
+
+
+def admins_of(schedule: List[Tuple[float, Dict]]) -> Dict[int, List[int]]:
+    admins: Dict[int, List[int]] = {}
+    for _, update in schedule:
+        message = update.get('message')
+        if message and message['chat']['id'] < 0 and message.get('text', '').startswith(ADMIN_COMMANDS):
+            chat_admins = admins.setdefault(message['chat']['id'], [])
+            if message['from']['id'] not in chat_admins:
+                chat_admins.append(message['from']['id'])
+    return admins
+
+
+def kind_of(update: Dict) -> str:
+    """ Command name, "text" or the update type, to group latencies by """
+    message = update.get('message')
+    if message is None:
+        return next((field for field in update if field != 'update_id'), 'unknown')
+    text = message.get('text', '')
+    return text.split(maxsplit=1)[0] if text.startswith('/') else 'text'
+
+
+class Replayer:
+    def __init__(self, app, fake_bot: FakeBot, link_wait: float = 10.0):
+        self.app = app
+        self.fake_bot = fake_bot
+        self.link_wait = link_wait
+        self.latencies: Dict[str, List[float]] = {}
+        self.missing_links = 0
+
+    async def resolve(self, update: Dict) -> Dict:
+        """ Points a recorded /start @<group> at the deep link this run sent to that group """
+        message = update.get('message')
+        text = message.get('text', '') if message else ''
+        if text.startswith(f"/start {START_REFERENCE}"):
+            group_chat_id = int(text.split(START_REFERENCE, 1)[1])
+            deadline = asyncio.get_running_loop().time() + self.link_wait
+            payload = self.fake_bot.deep_links.get(group_chat_id)
+            while payload is None and asyncio.get_running_loop().time() < deadline:
+                await asyncio.sleep(0.01)
+                payload = self.fake_bot.deep_links.get(group_chat_id)
+            if payload is None:
+                self.missing_links += 1
+                payload = 'unknown'
+            update = dict(update, message=dict(message, text=f"/start {payload}"))
+        return update
+
+    async def deliver(self, due: float, raw: Dict):
+        loop = asyncio.get_running_loop()
+        try:
+            update = self.app.types.Update.de_json(await self.resolve(raw))
+            await self.app.bot.process_new_updates([update])
+        except Exception as e:
+            print(f"An error occured: {e}")
+        self.latencies.setdefault(kind_of(raw), []).append(loop.time() - due)
+
+    async def replay(self, schedule: List[Tuple[float, Dict]], speed: float):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tasks = []
+        for offset, raw in schedule:
+            due = start + offset / speed
+            wait = due - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            tasks.append(asyncio.create_task(self.deliver(due, raw)))
+        await asyncio.gather(*tasks)
+
+
+def summarize(values: List[float]) -> Dict:
+    return {'count': len(values), 'p50_ms': percentile(values, 0.5) * 1000, 'p90_ms': percentile(values, 0.9) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000, 'max_ms': max(values, default=0.0) * 1000}
+
+
+async def run(args, speed: float) -> Dict:
+    configure_environment()
+    import shillgenx as app
+
+    schedule = load(args.recordings, args.max_gap)
+    fake_bot = FakeBot(args.tg_latency, args.jitter)
+    fake_bot.admins.update(admins_of(schedule))
+    install_fakes(app, fake_bot, FakeDatabase(args.db_latency, args.jitter), args.ai_latency, args.rate_limited)
+    await app.ensure_indexes(app.db)
+    replayer = Replayer(app, fake_bot, args.link_wait)
+
+    start = time.perf_counter()
+    await replayer.replay(schedule, speed)
+    elapsed = time.perf_counter() - start
+
+    duration = schedule[-1][0] / speed if schedule else 0.0
+    latencies = [value for values in replayer.latencies.values() for value in values]
+    return {
+        'speed': speed,
+        'updates': len(schedule),
+        'offered_per_second': len(schedule) / duration if duration else 0.0,
+        'handled_per_second': len(schedule) / elapsed if elapsed else 0.0,
+        'seconds': elapsed,
+        'busy': app.mailboxes.rejected,
+        'missing_links': replayer.missing_links,
+        'latency': summarize(latencies),
+        'kinds': {kind: summarize(values) for kind, values in sorted(replayer.latencies.items())},
+    }
+
+
+def run_in_process(args, speed: float) -> Dict:
+    return asyncio.run(run(args, speed))
+
+
+def report(result: Dict):
+    latency = result['latency']
+    print(f"speed {result['speed']:g}x: {result['updates']} updates offered at {result['offered_per_second']:.1f}/s, "
+          f"handled at {result['handled_per_second']:.1f}/s, {result['busy']} busy, {result['missing_links']} unresolved deep links")
+    print(f"{'kind':<20} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind, stats in [('all', latency)] + list(result['kinds'].items()):
+        print(f"{kind:<20} {stats['count']:>7} {stats['p50_ms']:>9.2f} {stats['p90_ms']:>9.2f} "
+              f"{stats['p99_ms']:>9.2f} {stats['max_ms']:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recordings', nargs='+', help="JSONL files written by tg.recorder")
+    parser.add_argument('--speed', default='1', help="replay speed, or a comma separated list of increasing speeds")
+    parser.add_argument('--max-gap', type=float, default=60.0, help="longest idle gap kept, in recorded seconds")
+    parser.add_argument('--link-wait', type=float, default=10.0, help="longest wait for a deep link to be sent")
+    parser.add_argument('--slo', type=float, default=1.0, help="p99 latency in seconds a speed must stay under")
+    parser.add_argument('--tg-latency', type=float, default=0.0)
+    parser.add_argument('--db-latency', type=float, default=0.0)
+    parser.add_argument('--ai-latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--rate-limited', action='store_true', help="keep Telegram's rate limits in the send queue")
+    args = parser.parse_args()
+
+    speeds = [float(speed) for speed in args.speed.split(',')]
+    if len(speeds) == 1:
+        report(run_in_process(args, speeds[0]))
+        return
+
+    sustained = saturated = None
+    for speed in speeds:
+        # A fresh interpreter per speed, so no state carries over between runs
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            result = pool.submit(run_in_process, args, speed).result()
+        report(result)
+        if result['latency']['p99_ms'] > args.slo * 1000 or result['busy']:
+            saturated = result
+            break
+        sustained = result
+    if sustained:
+        print(f"Sustained up to {sustained['speed']:g}x ({sustained['offered_per_second']:.1f} updates/s offered, "
+              f"p99 {sustained['latency']['p99_ms']:.0f}ms).")
+    if saturated:
+        print(f"Saturated at {saturated['speed']:g}x ({saturated['offered_per_second']:.1f} updates/s offered).")
+    else:
+        print("Not saturated, try higher speeds.")
+
+
+if __name__ == '__main__':
+    main()
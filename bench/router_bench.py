@@ -0,0 +1,58 @@
+""" Per-update dispatch cost of StateRouter against one predicate per state,
+    the way pyTelegramBotAPI evaluates `message_handler(func=...)` handlers.
+
+    python -m bench.router_bench
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+from tg.router import StateRouter
+
+UPDATES = 100000
+STATE_COUNTS = (7, 50, 500)
+
+
+def make_message(chat_id):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), from_user=SimpleNamespace(id=1), text="hello")
+
+
+async def noop(message):
+    pass
+
+
+async def run_predicates(chat_states, state_count, messages):
+    handlers = [(lambda message, state=state: chat_states.get(message.chat.id, {}).get('state') == state, noop)
+                for state in range(state_count)]
+    start = time.perf_counter()
+    for message in messages:
+        for predicate, handler in handlers:
+            if predicate(message):
+                await handler(message)
+                break
+    return time.perf_counter() - start
+
+
+async def run_router(chat_states, state_count, messages):
+    router = StateRouter(chat_states)
+    for state in range(state_count):
+        router.route(state)(noop)
+    start = time.perf_counter()
+    for message in messages:
+        await router.dispatch(message)
+    return time.perf_counter() - start
+
+
+async def main():
+    print(f"{'states':>8} {'predicates ns/update':>22} {'router ns/update':>18}")
+    for state_count in STATE_COUNTS:
+        # Chats are spread evenly over the states, so on average half the predicates run
+        chat_states = {chat_id: {'state': chat_id % state_count, 'current_user': 1} for chat_id in range(1000)}
+        messages = [make_message(i % 1000) for i in range(UPDATES)]
+        predicates = await run_predicates(chat_states, state_count, messages)
+        router = await run_router(chat_states, state_count, messages)
+        print(f"{state_count:>8} {predicates / UPDATES * 1e9:>22.0f} {router / UPDATES * 1e9:>18.0f}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,28 @@
+""" Lookup cost of ai.similarity.SimHashIndex as the number of stored posts grows.
+
+    python -m bench.similarity_bench
+"""
+import random
+import timeit
+
+from ai.similarity import SimHashIndex, simhash
+
+SIZES = (1000, 10000, 50000, 100000)
+ROUNDS = 1000
+POST = "Bench Project is building the fastest raid tooling on chain, join the community today $BENCH #bench"
+
+
+def main():
+    print(f"simhash of a post: {min(timeit.repeat(lambda: simhash(POST), number=ROUNDS, repeat=3)) / ROUNDS * 1e6:.1f} us")
+    print(f"{'stored posts':>12} {'lookup us':>10}")
+    for size in SIZES:
+        index = SimHashIndex()
+        for _ in range(size):
+            index.add('bench', random.getrandbits(64))
+        signature = random.getrandbits(64)
+        lookup = min(timeit.repeat(lambda: index.nearest('bench', signature), number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+        print(f"{size:>12} {lookup:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
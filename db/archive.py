@@ -0,0 +1,162 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from bson import json_util
+from pymongo.errors import BulkWriteError, CollectionInvalid
+
+
+class MongoArchiveStore:
+    """ Archived documents kept in `<collection>_archive` collections, created with
+        zstd block compression so cold documents take a fraction of their live size.
+    """
+    def __init__(self, db, suffix: str = '_archive'):
+        self.db = db
+        self.suffix = suffix
+        self._created = set()
+
+    async def _collection(self, name: str):
+        name = f"{name}{self.suffix}"
+        if name not in self._created:
+            try:
+                await self.db.create_collection(name, storageEngine={'wiredTiger': {'configString': 'block_compressor=zstd'}})
+            except CollectionInvalid:
+                # Already exists
+                pass
+            self._created.add(name)
+        return self.db[name]
+
+    async def write(self, name: str, docs: List[Dict]):
+        collection = await self._collection(name)
+        try:
+            await collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Documents archived by a run that stopped before deleting them are already there
+            if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+
+
+class FileArchiveStore:
+    """ Archived documents appended as extended JSON lines to `<path>/<name>-<day>.jsonl.zst`,
+        one zstd frame per batch. Read back with `zstd -dc` or read_archive().
+    """
+    def __init__(self, path: str, level: int = 10):
+        # Imported here, only the file store needs it
+        import zstandard
+        self.path = path
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+    async def write(self, name: str, docs: List[Dict]):
+        data = ''.join(f"{json_util.dumps(doc)}\n" for doc in docs).encode()
+        frame = self.compressor.compress(data)
+        file = os.path.join(self.path, f"{name}-{datetime.now(timezone.utc):%Y-%m-%d}.jsonl.zst")
+        await asyncio.to_thread(self._append, file, frame)
+
+    def _append(self, file: str, frame: bytes):
+        os.makedirs(self.path, exist_ok=True)
+        with open(file, 'ab') as f:
+            f.write(frame)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def read_archive(file: str):
+    """ Documents of a FileArchiveStore file
+    """
+    import zstandard
+    with open(file, 'rb') as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        buffer = b''
+        while chunk := reader.read(1 << 16):
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                yield json_util.loads(line)
+
+
+class Archiver:
+    """ Moves finished raid targets and their posts out of the live collections.
+
+        Every `interval` seconds, targets created more than `archive_after`
+        seconds ago without a pending unlock are read in batches of
+        `batch_size` (oldest first, on the created_at index), written to
+        `store` together with their posts, then deleted from the live
+        collections. A document is only deleted once its batch is stored, so
+        a crash in between archives it twice rather than losing it.
+        `before_archive(target_docs)` runs first on each batch, for anything
+        that still has to read the targets.
+    """
+    def __init__(self, targets, posts, store, archive_after: float = 7 * 24 * 3600, interval: float = 3600,
+                 batch_size: int = 500, before_archive: Optional[Callable[[List[Dict]], Awaitable[None]]] = None):
+        self.targets = targets
+        self.posts = posts
+        self.store = store
+        self.archive_after = archive_after
+        self.interval = interval
+        self.batch_size = batch_size
+        self.before_archive = before_archive
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.archived_targets = 0
+        self.archived_posts = 0
+        self.errors = 0
+
+    async def archive(self) -> int:
+        """ Archive every finished target. Returns the number of targets moved.
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.archive_after)
+        moved = 0
+        while True:
+            cursor = self.targets.find({"created_at": {"$lt": cutoff}, "unlock_at": {"$exists": False}})
+            targets = await cursor.sort("created_at", 1).limit(self.batch_size).to_list(self.batch_size)
+            if not targets:
+                break
+            await self._archive_batch(targets)
+            moved += len(targets)
+            if len(targets) < self.batch_size:
+                break
+        self.runs += 1
+        return moved
+
+    async def _archive_batch(self, targets: List[Dict]):
+        target_ids = [target["_id"] for target in targets]
+        # Posts refer to their target by its id as a string
+        post_filter = {"shill_target_id": {"$in": [str(target_id) for target_id in target_ids]}}
+        posts = await self.posts.find(post_filter).to_list(None)
+
+        if self.before_archive is not None:
+            await self.before_archive(targets)
+        if posts:
+            await self.store.write(self.posts.name, posts)
+        await self.store.write(self.targets.name, targets)
+
+        await self.posts.delete_many(post_filter)
+        await self.targets.delete_many({"_id": {"$in": target_ids}})
+        self.archived_targets += len(targets)
+        self.archived_posts += len(posts)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive()
+            except Exception as e:
+                self.errors += 1
+                print(f"An error occured: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'archived_targets': self.archived_targets,
+            'archived_posts': self.archived_posts,
+            'errors': self.errors,
+        }
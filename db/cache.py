@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Tuple
+
+# Stored in place of None so "this chat has no project" is cached as well
+_NO_PROJECT = object()
+
+
+class MemoryCacheBackend:
+    """ In-process LRU with per-entry expiry.
+
+        Backends are async so a shared store (e.g. Redis) can implement the
+        same get/set/add/delete methods and be shared between bot processes.
+    """
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[1]
+
+    async def set(self, key, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def add(self, key, value, ttl: float) -> bool:
+        """ Set only if the key is absent (like Redis SET NX). Returns whether it was set.
+        """
+        found, _ = await self.get(key)
+        if found:
+            return False
+        await self.set(key, value, ttl)
+        return True
+
+    async def delete(self, key):
+        self._entries.pop(key, None)
+
+
+class ProjectCache:
+    """ Read-through cache of project documents keyed by group_chat_id
+        (also used for raid targets keyed by their _id).
+
+        Chats without a project are cached for the shorter `negative_ttl`.
+        Writers refresh the entry with `put()` or drop it with `invalidate()`.
+        Cached documents are shared, callers must not mutate them.
+    """
+    def __init__(self, backend, ttl: float = 600, negative_ttl: float = 60):
+        self.backend = backend
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, group_chat_id, load: Callable[[Any], Awaitable[Any]]):
+        found, value = await self.backend.get(group_chat_id)
+        if found:
+            self.hits += 1
+            return None if value is _NO_PROJECT else value
+
+        self.misses += 1
+        project = await load(group_chat_id)
+        await self.put(group_chat_id, project)
+        return project
+
+    async def put(self, group_chat_id, project):
+        if project is None:
+            await self.backend.set(group_chat_id, _NO_PROJECT, self.negative_ttl)
+        else:
+            await self.backend.set(group_chat_id, project, self.ttl)
+
+    async def invalidate(self, group_chat_id):
+        await self.backend.delete(group_chat_id)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
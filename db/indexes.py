@@ -0,0 +1,69 @@
+from typing import Dict, Optional
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+# Indexes every collection needs, created once at startup by ensure_indexes()
+INDEXES = {
+    "project": [
+        # One project per group chat. db_add_project relies on it to reject duplicates.
+        IndexModel([("group_chat_id", ASCENDING)], unique=True, name="group_chat_id_unique"),
+        # Groups of the same project, looked up by the /sgx_raid_all fan-out
+        IndexModel([("x_handle", ASCENDING)], name="x_handle"),
+    ],
+    "target": [
+        IndexModel([("group_chat_id", ASCENDING), ("created_at", DESCENDING)], name="group_chat_id_created_at"),
+        # Pending unlocks re-armed by the lock scheduler on startup
+        IndexModel([("unlock_at", ASCENDING)], sparse=True, name="unlock_at_sparse"),
+    ],
+    "post": [
+        # Unclaimed posts of a target, picked up by PostPool after a restart
+        IndexModel([("shill_target_id", ASCENDING), ("claimed_by", ASCENDING)], name="shill_target_id_claimed_by"),
+    ],
+    "raid_stats": [
+        # Rollup rows of a group, newest day first (db.stats.RaidStats.days)
+        IndexModel([("_id.group_chat_id", ASCENDING), ("_id.day", DESCENDING)], name="group_chat_id_day"),
+    ],
+}
+
+
+# Field every collection's documents expire after, indexed whether or not a TTL is set.
+# The archiver also finds finished targets through it.
+TTL_FIELDS = {
+    "target": "created_at",
+    "post": "created_at",
+}
+
+
+async def ensure_indexes(db, ttls: Optional[Dict[str, float]] = None):
+    """ Create any missing index. Existing indexes with the same definition are left alone.
+        `ttls` maps collections of TTL_FIELDS to the seconds their documents are kept, 0 for ever.
+    """
+    for collection_name, models in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(models)
+        except Exception as e:
+            print(f"An error occured while creating indexes on {collection_name}: {e}")
+    ttls = ttls or {}
+    for collection_name, field in TTL_FIELDS.items():
+        try:
+            await ensure_ttl_index(db, collection_name, field, ttls.get(collection_name, 0))
+        except Exception as e:
+            print(f"An error occured while creating the TTL index on {collection_name}: {e}")
+
+
+async def ensure_ttl_index(db, collection_name: str, field: str, ttl: float):
+    """ Index `field`, expiring documents `ttl` seconds after it unless `ttl` is 0.
+        A changed ttl is applied in place, turning expiry on or off rebuilds the index.
+    """
+    collection = db[collection_name]
+    expire_after = int(ttl) if ttl > 0 else None
+    existing = (await collection.index_information()).get(field)
+    if existing is not None:
+        if existing.get("expireAfterSeconds") == expire_after:
+            return
+        if expire_after is not None and "expireAfterSeconds" in existing:
+            await db.command("collMod", collection_name, index={"name": field, "expireAfterSeconds": expire_after})
+            return
+        await collection.drop_index(field)
+    options = {"expireAfterSeconds": expire_after} if expire_after is not None else {}
+    await collection.create_index([(field, ASCENDING)], name=field, **options)
@@ -0,0 +1,179 @@
+import asyncio
+import itertools
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from db.schemas import Project, ShillgenXTarget, ShillPost, post_codec
+
+POST_MOODS = ['bullish', 'excited', 'confident', 'witty', 'curious']
+
+
+class PostPool:
+    """ Pre-generated ShillPost documents per raid target, shared by every process.
+
+        Posts are claimed straight from the collection with a single
+        find_one_and_update on an unclaimed post, so two processes never hand
+        one out twice and a raider's /start can land on any process. Whenever
+        a target drops below `low_watermark` unclaimed posts, a background
+        task tops it up to `size`. Only the process holding the target's lease
+        in `leases` generates, so the process that called fill() generates the
+        first posts and the others pick them up instead of generating their
+        own. A lease left behind by a crash expires after `lease_ttl` seconds.
+
+        `generate(project, topic, mood)` returns the text of one post. With
+        `similarity`, a function building an ai.similarity.SimHashIndex on the
+        first refill (so processes that never generate never import numpy),
+        posts too close to one already generated for the same group are
+        dropped and regenerated from the next topic/mood, up to
+        `regenerate_attempts` more rounds.
+    """
+    def __init__(self, collection, leases, generate: Callable[[Project, str, str], Awaitable[str]],
+                 size: int = 20, low_watermark: int = 5, max_targets: int = 1000, lease_ttl: float = 120.0,
+                 poll_interval: float = 0.25, similarity: Optional[Callable[[], object]] = None,
+                 regenerate_attempts: int = 1):
+        self.collection = collection
+        self.leases = leases
+        self.generate = generate
+        self.size = size
+        self.low_watermark = low_watermark
+        self.max_targets = max_targets
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.make_similarity = similarity
+        self.similarity = None
+        self.regenerate_attempts = regenerate_attempts
+        # Topic/mood combinations used so far per target, so refills carry on where the last one stopped
+        self._generated: "OrderedDict[str, int]" = OrderedDict()
+        self._refills: Dict[str, asyncio.Task] = {}
+
+    def fill(self, target: ShillgenXTarget, project: Project):
+        """ Start generating posts for a target in the background
+        """
+        async def load():
+            return target, project
+
+        self._refill_if_low(str(target._id), load)
+
+    async def claim(self, target_id: str, user_id: int, load: Callable[[], Awaitable[Optional[Tuple[ShillgenXTarget, Project]]]],
+                    wait: float = 10.0) -> Optional[ShillPost]:
+        """ Hand out an unused post, waiting up to `wait` seconds for a refill if none is ready.
+            `load()` returns the target and its project, or None if the raid is gone. It is only
+            called when the pool has to be topped up, so a ready post costs a single round trip.
+        """
+        target_id = str(target_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            doc = await self.collection.find_one_and_update({"shill_target_id": target_id, "claimed_by": None},
+                                                            {"$set": {"claimed_by": user_id}},
+                                                            return_document=ReturnDocument.AFTER)
+            # Tops the pool up in the background once it runs low
+            refill = self._refill_if_low(target_id, load)
+            if doc is not None:
+                return post_codec.decode(doc)
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                added = await asyncio.wait_for(asyncio.shield(refill), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if not added:
+                # Another process holds the lease, its posts show up in the collection
+                await asyncio.sleep(min(self.poll_interval, max(0.0, deadline - loop.time())))
+
+    def _refill_if_low(self, target_id: str, load) -> asyncio.Task:
+        refill = self._refills.get(target_id)
+        if refill is None:
+            refill = self._refills[target_id] = asyncio.create_task(self._refill(target_id, load))
+            refill.add_done_callback(lambda _: self._refills.pop(target_id, None))
+        return refill
+
+    async def _unclaimed(self, target_id: str) -> int:
+        return await self.collection.count_documents({"shill_target_id": target_id, "claimed_by": None})
+
+    async def _lease(self, target_id: str) -> bool:
+        now = datetime.now(timezone.utc)
+        # Left behind by a process that stopped in the middle of a refill
+        await self.leases.delete_one({"_id": target_id, "until": {"$lt": now}})
+        try:
+            await self.leases.insert_one({"_id": target_id, "until": now + timedelta(seconds=self.lease_ttl)})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def _refill(self, target_id: str, load) -> int:
+        """ Returns the number of posts added
+        """
+        try:
+            if await self._unclaimed(target_id) >= self.low_watermark or not await self._lease(target_id):
+                return 0
+        except Exception as e:
+            print(f"An error occured: {e}")
+            return 0
+        try:
+            # Counted again under the lease, the previous holder may have just topped it up
+            missing = self.size - await self._unclaimed(target_id)
+            loaded = await load() if missing > 0 else None
+            if loaded is None:
+                return 0
+            target, project = loaded
+            return await self._generate_missing(target_id, target, project, missing)
+        except Exception as e:
+            print(f"An error occured: {e}")
+            return 0
+        finally:
+            try:
+                await self.leases.delete_one({"_id": target_id})
+            except Exception as e:
+                # Expires after lease_ttl
+                print(f"An error occured: {e}")
+
+    def _next_combination(self, target_id: str, count: int) -> int:
+        start = self._generated.get(target_id, 0)
+        self._generated[target_id] = start + count
+        self._generated.move_to_end(target_id)
+        while len(self._generated) > self.max_targets:
+            self._generated.popitem(last=False)
+        return start
+
+    async def _generate_missing(self, target_id: str, target: ShillgenXTarget, project: Project, missing: int) -> int:
+        if missing <= 0:
+            return 0
+        if self.similarity is None and self.make_similarity is not None:
+            self.similarity = self.make_similarity()
+
+        # Carry on through topics x moods from where the previous refill stopped
+        combinations = list(itertools.product(project.topics.keys(), POST_MOODS))
+        posts = []
+        now = datetime.now(timezone.utc)
+        for _ in range(1 + self.regenerate_attempts):
+            wanted = missing - len(posts)
+            start = self._next_combination(target_id, wanted)
+            picks = [combinations[(start + i) % len(combinations)] for i in range(wanted)]
+
+            texts = await asyncio.gather(*(self.generate(project, topic, mood) for topic, mood in picks),
+                                         return_exceptions=True)
+            duplicates = 0
+            for (topic, mood), text in zip(picks, texts):
+                if isinstance(text, BaseException):
+                    print(f"An error occured while generating a post: {text}")
+                    continue
+                if self.similarity is not None and not self.similarity.add_if_unique(target.group_chat_id, text):
+                    duplicates += 1
+                    continue
+                posts.append(ShillPost(shill_target_id=target_id, group_chat_id=target.group_chat_id,
+                                       x_target_link=target.x_target_link, shill=text, topic=topic, mood=mood,
+                                       created_at=now))
+            # Only near-duplicates are regenerated, failed generations are left to the next refill
+            if not duplicates:
+                break
+
+        if posts:
+            await self.collection.insert_many([post_codec.encode(post) for post in posts])
+        return len(posts)
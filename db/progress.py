@@ -0,0 +1,183 @@
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from db.schemas import ShillgenXTarget
+
+GOAL_KINDS = ('comments', 'reposts', 'likes', 'bookmarks')
+
+
+class GoalTracker:
+    """ Raid goal progress with write-behind counters.
+
+        `record()` only touches memory: the increment is added to the
+        target's live count and to a per-target buffer. Every
+        `flush_interval` seconds the buffers are written as one unordered
+        bulk_write of `$inc` updates on the targets' `progress` field, so a
+        crash loses at most the increments since the last flush. A failed
+        write puts its increments back in the buffer.
+
+        The written targets' progress is then read back with a single find,
+        so goals are checked against counts that hold every process's
+        increments, in two round trips per flush however many targets there
+        are. A goal is announced once: the first process to see it reached
+        sets `reached.<kind>` with a conditional update and only that
+        process calls `on_goal_reached(target, kind, count)`. Live counts
+        are refreshed from the same stored progress.
+    """
+    def __init__(self, collection, on_goal_reached: Callable[[ShillgenXTarget, str, int], Awaitable[None]],
+                 flush_interval: float = 5.0, max_targets: int = 1000):
+        self.collection = collection
+        self.on_goal_reached = on_goal_reached
+        self.flush_interval = flush_interval
+        self.max_targets = max_targets
+        self._targets: "OrderedDict[str, ShillgenXTarget]" = OrderedDict()
+        self._live: Dict[str, Dict[str, int]] = {}
+        self._pending: Dict[str, Dict[str, int]] = {}
+        self._notifications = set()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flushed_increments = 0
+        self.flush_errors = 0
+
+    def __len__(self):
+        return len(self._targets)
+
+    def track(self, target: ShillgenXTarget):
+        """ Start counting for a target. Its stored progress is the starting point.
+        """
+        target_id = str(target._id)
+        if target_id not in self._targets:
+            self._live[target_id] = dict(target.progress)
+        self._targets[target_id] = target
+        self._targets.move_to_end(target_id)
+        while len(self._targets) > self.max_targets:
+            # Targets with unflushed increments stay until the next flush
+            evicted = next((key for key in self._targets if key not in self._pending and key != target_id), None)
+            if evicted is None:
+                break
+            del self._targets[evicted]
+            del self._live[evicted]
+
+    def progress(self, target_id) -> Dict[str, int]:
+        return dict(self._live.get(str(target_id), {}))
+
+    def record(self, target: ShillgenXTarget, kind: str, amount: int = 1) -> int:
+        """ Count `amount` raider actions of `kind` and return the live count
+        """
+        if kind not in GOAL_KINDS:
+            raise ValueError(f"Unknown goal: {kind}")
+        self.track(target)
+        target_id = str(target._id)
+
+        live = self._live[target_id]
+        live[kind] = live.get(kind, 0) + amount
+        pending = self._pending.setdefault(target_id, {})
+        pending[kind] = pending.get(kind, 0) + amount
+        return live[kind]
+
+    async def _notify(self, target: ShillgenXTarget, kind: str, count: int):
+        try:
+            result = await self.collection.update_one(
+                {"_id": target._id, f"reached.{kind}": {"$exists": False}},
+                {"$set": {f"reached.{kind}": datetime.now(timezone.utc)}}
+            )
+            if result.modified_count:
+                await self.on_goal_reached(target, kind, count)
+        except Exception as e:
+            print(f"An error occured: {e}")
+
+    def _check(self, target_id: str, target: ShillgenXTarget, kinds, doc: Dict):
+        """ Refresh the live counts from a target's stored progress and announce the goals it reached
+        """
+        progress = doc.get("progress") or {}
+        reached = doc.get("reached") or {}
+        live = self._live.get(target_id)
+        for kind in kinds:
+            count = progress.get(kind, 0)
+            if live is not None:
+                # Every process's increments, plus ours recorded since this flush started
+                live[kind] = count + self._pending.get(target_id, {}).get(kind, 0)
+            goal = target.goals.get(kind)
+            if goal and count >= goal and kind not in reached:
+                notification = asyncio.create_task(self._notify(target, kind, count))
+                self._notifications.add(notification)
+                notification.add_done_callback(self._notifications.discard)
+
+    async def flush(self) -> int:
+        """ Write the buffered increments. Returns the number of targets updated.
+        """
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        target_ids = list(pending)
+        targets = {target_id: self._targets[target_id] for target_id in target_ids}
+        requests = [UpdateOne({"_id": targets[target_id]._id},
+                              {"$inc": {f"progress.{kind}": amount for kind, amount in pending[target_id].items()}})
+                    for target_id in target_ids]
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+            failed = []
+        except BulkWriteError as e:
+            # The other updates were applied, only the failed ones are retried
+            failed = [target_ids[error['index']] for error in e.details.get('writeErrors', [])]
+            print(f"An error occured: {e}")
+        except Exception as e:
+            failed = target_ids
+            print(f"An error occured: {e}")
+
+        for target_id in failed:
+            # Tracked again in case it was evicted while the write was in flight
+            self._targets.setdefault(target_id, targets[target_id])
+            buffered = self._pending.setdefault(target_id, {})
+            for kind, amount in pending[target_id].items():
+                buffered[kind] = buffered.get(kind, 0) + amount
+        if failed:
+            self.flush_errors += 1
+
+        failed = set(failed)
+        written = [target_id for target_id in target_ids if target_id not in failed]
+        self.flushes += 1
+        self.flushed_increments += sum(sum(pending[target_id].values()) for target_id in written)
+
+        if written:
+            try:
+                # Read back in one query: the stored progress holds every process's increments
+                by_id = {str(target_id): target_id for target_id in written}
+                cursor = self.collection.find({"_id": {"$in": [targets[target_id]._id for target_id in written]}},
+                                              {"progress": 1, "reached": 1})
+                async for doc in cursor:
+                    target_id = by_id.get(str(doc["_id"]))
+                    if target_id is not None:
+                        self._check(target_id, targets[target_id], pending[target_id], doc)
+            except Exception as e:
+                # Checked again after the target's next flush
+                print(f"An error occured: {e}")
+        return len(written)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def stats(self):
+        return {
+            'targets': len(self._targets),
+            'pending_targets': len(self._pending),
+            'flushes': self.flushes,
+            'flushed_increments': self.flushed_increments,
+            'flush_errors': self.flush_errors,
+        }
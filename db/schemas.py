@@ -1,9 +1,20 @@
 from enum import Enum
-from dataclasses import dataclass, field
-from typing import List, Dict
+from dataclasses import dataclass, field, fields, MISSING
+from datetime import datetime
+from typing import List, Dict, Optional
 
 import re
 
+# Compiled once at import instead of on every validation
+URL_REGEX = re.compile(
+    r'^(?:http://|https://)?'  # Optional http or https scheme
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'  # Domain
+    r'(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?))'  # Top level domain
+    r'(?:/?|[/?]\S+)?$', re.IGNORECASE)  # Optional rest of the URL
+# Words prefixed with '$' or '#', followed by word boundaries
+TAG_REGEX = re.compile(r'([$#]\w+)\b')
+X_LINK_REGEX = re.compile(r'https?://\S+')
+
 def validate_non_empty_string(value, min_char):
     return isinstance(value, str) and len(value) >= min_char
 
@@ -15,24 +26,17 @@ print(validate_url("https://www.example.com"))  # True
 print(validate_url("www.example.com:8080"))  # False
 """
 def validate_url(url):
-    # Regex for validating a URL with optional scheme and excluding port
-    regex = re.compile(
-        r'^(?:http://|https://)?'  # Optional http or https scheme
-        r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+'  # Domain
-        r'(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?))'  # Top level domain
-        r'(?:/?|[/?]\S+)?$', re.IGNORECASE)  # Optional rest of the URL
-    return re.match(regex, url) is not None
+    # Validates a URL with optional scheme and excluding port
+    return URL_REGEX.match(url) is not None
 
 def find_tags_in_string(text):
-    # Regular expression to find words prefixed with '$' or '#', followed by word boundaries
-    pattern = r'([$#]\w+)\b'
-    return re.findall(pattern, text)
+    return TAG_REGEX.findall(text)
 
 class Schemas(Enum):
     projects = 1
     targets = 2
 
-@dataclass
+@dataclass(slots=True)
 class Project:
     _id: str = ""
     group_chat_id: str = ""
@@ -108,19 +112,22 @@ class Project:
         self.topics = value
 
 
-@dataclass
+@dataclass(slots=True)
 class ShillgenXTarget:
     _id: str = ''
     project_id: str = ''
     group_chat_id: str = ''
     x_target_link: str = ''
     lock_duration: int = 1
+    created_at: Optional[datetime] = None
     goals: Dict[str, int] = field(default_factory=lambda: {
         'comments': 1,
         'reposts': 1,
         'likes': 1,
         'bookmarks': 1
     })
+    # Raider actions counted so far per goal, maintained by db.progress.GoalTracker
+    progress: Dict[str, int] = field(default_factory=dict)
 
     def set_project_id(self, value: str):
         self.project_id = value
@@ -130,7 +137,7 @@ class ShillgenXTarget:
 
     def set_x_target_link(self, value: str):
         # Assuming the x_target_link should be a valid URL
-        if isinstance(value, str) and re.match(r'https?://\S+', value):
+        if isinstance(value, str) and X_LINK_REGEX.match(value):
             self.x_target_link = value
         else:
             raise ValueError("Invalid X post link.")
@@ -173,12 +180,57 @@ class ShillgenXTarget:
         else:
             raise ValueError("Goals must be provided as a comma-separated string")
 
-@dataclass
+@dataclass(slots=True)
 class ShillPost:
-    _id: str
-    shill_target_id: str
-    group_chat_id: str
-    shill: str
+    _id: str = ''
+    shill_target_id: str = ''
+    group_chat_id: str = ''
+    # Copied from the target so /start can answer from the claimed post alone
+    x_target_link: str = ''
+    shill: str = ''
+    topic: str = ''
+    mood: str = ''
+    claimed_by: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+class Codec:
+    """ Maps a schema dataclass to and from a BSON-ready dict.
+
+        Unlike dataclasses.asdict nothing is deep copied: the document shares
+        the object's lists and dicts, which is fine since it is serialised
+        right away. An empty `_id` is left out so Mongo assigns one, and
+        unknown document keys are ignored when decoding. Field names and
+        defaults are looked up once per class.
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        self.names = tuple(f.name for f in fields(cls))
+        self.defaults = {}
+        for f in fields(cls):
+            if f.default is not MISSING:
+                self.defaults[f.name] = lambda value=f.default: value
+            elif f.default_factory is not MISSING:
+                self.defaults[f.name] = f.default_factory
+
+    def encode(self, obj) -> Dict:
+        doc = {name: getattr(obj, name) for name in self.names}
+        if not doc['_id']:
+            del doc['_id']
+        return doc
+
+    def decode(self, doc: Optional[Dict]):
+        if doc is None:
+            return None
+        # Without calling __init__, stored values are trusted as they are
+        obj = self.cls.__new__(self.cls)
+        for name in self.names:
+            setattr(obj, name, doc[name] if name in doc else self.defaults[name]())
+        return obj
+
+
+project_codec = Codec(Project)
+target_codec = Codec(ShillgenXTarget)
+post_codec = Codec(ShillPost)
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,100 @@
+import time
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List
+
+from db.progress import GOAL_KINDS
+
+DAY_FORMAT = '%Y-%m-%d'
+# Columns of every rollup row after group_chat_id and day
+ROLLUP_FIELDS = ['raids'] + [f"{kind}_{column}" for kind in GOAL_KINDS for column in ('goal', 'done', 'reached')]
+
+
+def raid_pipeline(group_chat_id: int, since: datetime) -> List[Dict]:
+    """ Raids of a group per day: how many, and for each goal the sum of the goals
+        set, the actions counted and how many raids reached it.
+    """
+    group = {'_id': {'group_chat_id': '$group_chat_id', 'day': {'$dateToString': {'format': DAY_FORMAT, 'date': '$created_at'}}},
+             'raids': {'$sum': 1}}
+    for kind in GOAL_KINDS:
+        goal = {'$ifNull': [f'$goals.{kind}', 0]}
+        done = {'$ifNull': [f'$progress.{kind}', 0]}
+        group[f'{kind}_goal'] = {'$sum': goal}
+        group[f'{kind}_done'] = {'$sum': done}
+        # Raids without this goal do not count as reaching it
+        group[f'{kind}_reached'] = {'$sum': {'$cond': [{'$and': [{'$gt': [goal, 0]}, {'$gte': [done, goal]}]}, 1, 0]}}
+    return [
+        # Served by the (group_chat_id, created_at) index
+        {'$match': {'group_chat_id': group_chat_id, 'created_at': {'$gte': since}}},
+        {'$group': group},
+    ]
+
+
+class RaidStats:
+    """ Per day raid rollups kept in their own collection.
+
+        `refresh()` re-aggregates only the raids created in the last
+        `lookback_days` (goal progress keeps being flushed for a while after a
+        raid) plus anything since the previous refresh, and $merges the result
+        into the rollup collection, so the cost of a query does not grow with
+        the group's history. The first refresh of a group covers everything.
+        Refreshes closer than `refresh_interval` seconds are skipped unless forced.
+    """
+    def __init__(self, targets, rollups, state, lookback_days: int = 2, refresh_interval: float = 60, batch_size: int = 100):
+        self.targets = targets
+        self.rollups = rollups
+        self.state = state
+        self.lookback_days = lookback_days
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self._refreshed: Dict[int, float] = {}
+
+    async def refresh(self, group_chat_id: int, force: bool = False):
+        if not force and time.monotonic() - self._refreshed.get(group_chat_id, float('-inf')) < self.refresh_interval:
+            return
+
+        now = datetime.now(timezone.utc)
+        state = await self.state.find_one({'_id': group_chat_id})
+        since = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        if state is not None:
+            rolled_at = state['rolled_at']
+            if rolled_at.tzinfo is None:
+                rolled_at = rolled_at.replace(tzinfo=timezone.utc)
+            since = min(rolled_at, now) - timedelta(days=self.lookback_days)
+            # Whole days, so each merged row covers every raid of its day
+            since = since.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        pipeline = raid_pipeline(group_chat_id, since) + [
+            {'$merge': {'into': self.rollups.name, 'on': '_id', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}},
+        ]
+        async for _ in self.targets.aggregate(pipeline):
+            pass
+        await self.state.update_one({'_id': group_chat_id}, {'$set': {'rolled_at': now}}, upsert=True)
+        self._refreshed[group_chat_id] = time.monotonic()
+
+    async def days(self, group_chat_id: int, days: int = 0) -> AsyncIterator[Dict]:
+        """ Rollup rows of a group, newest day first, limited to the last `days` days unless 0
+        """
+        query = {'_id.group_chat_id': group_chat_id}
+        if days:
+            first_day = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime(DAY_FORMAT)
+            query['_id.day'] = {'$gte': first_day}
+        cursor = self.rollups.find(query).sort('_id.day', -1).batch_size(self.batch_size)
+        async for row in cursor:
+            yield row
+
+
+def format_summary(rows: List[Dict]) -> str:
+    if not rows:
+        return "No raids yet."
+    lines = []
+    for row in rows:
+        goals = ', '.join(f"{kind} {row[f'{kind}_done']}/{row[f'{kind}_goal']}" for kind in GOAL_KINDS)
+        lines.append(f"{row['_id']['day']}: {row['raids']} raid(s), {goals}")
+    return '\n'.join(lines)
+
+
+def csv_line(row: Dict) -> str:
+    return ','.join(str(value) for value in [row['_id']['group_chat_id'], row['_id']['day']] + [row.get(field, 0) for field in ROLLUP_FIELDS])
+
+
+CSV_HEADER = ','.join(['group_chat_id', 'day'] + ROLLUP_FIELDS)
@@ -0,0 +1,249 @@
+""" Low overhead instrumentation: counters, gauges and latency histograms
+    rendered in the Prometheus text format, plus optional per-update traces.
+
+    Wrap hot-path coroutines with `@instrument('db')`, `@instrument('tg')`,
+    `@instrument('handler')`... Each call then costs two perf_counter() reads,
+    a bisect and a few dict updates.
+"""
+import bisect
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(**labels) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = '') -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        self.inc_key(_labels(**labels), amount)
+
+    def inc_key(self, key: Labels, amount: float = 1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(labels)} {value}" for labels, value in self.values.items()]
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, amount: float = 1, **labels):
+        self.inc_key(_labels(**labels), -amount)
+
+    def set(self, value: float, **labels):
+        self.values[_labels(**labels)] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self.values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels):
+        self.observe_key(_labels(**labels), value)
+
+    def observe_key(self, key: Labels, value: float):
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(labels, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # (prefix, stats) pairs, stats() is read at render time
+        self.collectors: List[Tuple[str, Callable[[], Dict[str, float]]]] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        metric = Gauge(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, prefix: str, stats: Callable[[], Dict[str, float]]):
+        """ Export a component's stats() dict as gauges named `<prefix>_<key>`
+        """
+        self.collectors.append((prefix, stats))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for prefix, stats in self.collectors:
+            for key, value in stats().items():
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {float(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+call_seconds = registry.histogram('shillgenx_call_seconds', "Latency of instrumented calls")
+call_errors = registry.counter('shillgenx_call_errors_total', "Exceptions raised by instrumented calls")
+in_flight = registry.gauge('shillgenx_in_flight', "Instrumented calls currently running")
+errors = registry.counter('shillgenx_errors_total', "Errors caught and logged, by function")
+ai_tokens = registry.counter('shillgenx_ai_tokens_total', "OpenAI tokens used, by model and kind")
+
+
+#################################################################
+#                           TRACES                              #
+#################################################################
+_trace: contextvars.ContextVar = contextvars.ContextVar('shillgenx_trace', default=None)
+_trace_ids = itertools.count(1)
+traces: deque = deque(maxlen=200)
+tracing_enabled = False
+
+
+def enable_tracing(keep: int = 200):
+    global tracing_enabled, traces
+    tracing_enabled = True
+    traces = deque(maxlen=keep)
+
+
+def recent_traces() -> str:
+    return json.dumps(list(traces))
+
+
+#################################################################
+#                         INSTRUMENT                            #
+#################################################################
+def instrument(kind: str, name: Optional[str] = None):
+    """ Record latency, exceptions and in-flight count of an async function.
+        With tracing enabled, a 'handler' call starts a trace and every
+        instrumented call underneath it adds a span. An async generator is
+        timed from the call to its last item.
+    """
+    def decorator(function):
+        label = name or function.__name__
+        key = _labels(kind=kind, name=label)
+
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def generator_wrapper(*args, **kwargs):
+                trace = _trace.get()
+                in_flight.inc_key(key)
+                start = time.perf_counter()
+                items = function(*args, **kwargs)
+                try:
+                    async for item in items:
+                        yield item
+                except Exception:
+                    call_errors.inc_key(key)
+                    raise
+                finally:
+                    # Also when the caller stops early, so the generator releases what it holds
+                    await items.aclose()
+                    elapsed = time.perf_counter() - start
+                    in_flight.inc_key(key, -1)
+                    call_seconds.observe_key(key, elapsed)
+                    if trace is not None:
+                        trace['spans'].append({'kind': kind, 'name': label, 'ms': round(elapsed * 1000, 3)})
+            return generator_wrapper
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            trace = _trace.get()
+            token = None
+            if tracing_enabled and trace is None and kind == 'handler':
+                trace = {'id': next(_trace_ids), 'handler': label, 'started': time.time(), 'spans': []}
+                token = _trace.set(trace)
+
+            in_flight.inc_key(key)
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                call_errors.inc_key(key)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                in_flight.inc_key(key, -1)
+                call_seconds.observe_key(key, elapsed)
+                if trace is not None:
+                    trace['spans'].append({'kind': kind, 'name': label, 'ms': round(elapsed * 1000, 3)})
+                if token is not None:
+                    _trace.reset(token)
+                    traces.append(trace)
+        return wrapper
+    return decorator
+
+
+def log_error(where: str, e: Exception):
+    errors.inc(name=where)
+    print(f"An error occured: {e}")
+
+
+def record_tokens(model: str, prompt_tokens: int, completion_tokens: int):
+    ai_tokens.inc(prompt_tokens, model=model, kind='prompt')
+    ai_tokens.inc(completion_tokens, model=model, kind='completion')
+
+
+def make_app(app=None):
+    """ Add /metrics and /traces to an aiohttp app (a new one if none is given)
+    """
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def handle_traces(request):
+        return web.Response(text=recent_traces(), content_type='application/json')
+
+    app = app or web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/traces', handle_traces)
+    return app
@@ -1,18 +1,50 @@
+import os
+# Before any other import, so STARTUP_PROFILE=1 can time them all
+import startup
+if os.getenv('STARTUP_PROFILE') == '1':
+    startup.profile_imports()
+
 from telebot.async_telebot import AsyncTeleBot
-from telebot import types
+from telebot import types, util
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
-from dataclasses import asdict
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timezone
 from typing import List, Dict
-from openai import OpenAI
-import os
 import json
+import hashlib
+import random
+import secrets
+import time
 import asyncio
+import tempfile
 from motor.motor_asyncio import AsyncIOMotorClient
 
-from db.schemas import Project, ShillgenXTarget, Schemas
-
-load_dotenv()
+import metrics
+from metrics import instrument, log_error
+from db.schemas import Project, ShillgenXTarget, Schemas, project_codec, target_codec
+from db.archive import Archiver, FileArchiveStore, MongoArchiveStore
+from db.cache import ProjectCache, MemoryCacheBackend
+from db.indexes import ensure_indexes
+from db.posts import PostPool, POST_MOODS
+from db.progress import GoalTracker, GOAL_KINDS
+from db.stats import RaidStats, CSV_HEADER, csv_line, format_summary
+from ai.cache import DiskResponseCache
+from ai.client import AIClient, make_backend
+from ai.structured import generate_fields, IncompleteGenerationError
+from tg.scheduler import LockScheduler, MongoLockStore, FileLockStore
+from tg.admin_cache import AdminCache, ADMIN_STATUSES
+from tg.mailbox import ChatMailboxes, chat_id_of
+from tg.recorder import UpdateRecorder
+from tg.router import StateRouter
+from tg.sender import SendQueue, PRIORITY_CONTROL
+from tg.deeplink import DeepLinkSigner
+from tg.states import JournaledStates
+from tg.streaming import MessageStream
+from tg.webhook import ShardedDispatcher, make_app, serve_queue, shard_for, start_app
+
+with startup.stage('load_dotenv'):
+    load_dotenv()
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 bot = AsyncTeleBot(TELEGRAM_BOT_TOKEN)
@@ -23,61 +55,217 @@ MONGO_HOST = os.getenv('MONGO_HOST')
 MONGO_PORT = os.getenv('MONGO_PORT')
 MONGO_DB = os.getenv('MONGO_DB')
 conn_str = f"mongodb://{MONGO_USERNAME}:{MONGO_PASSWORD}@{MONGO_HOST}:{MONGO_PORT}/{MONGO_DB}"
-client = AsyncIOMotorClient(conn_str)
+# Connection pool of each process. Nothing connects before the first operation, or before startup
+# when MONGO_WARMUP opens MONGO_MIN_POOL_SIZE connections (at least one) ahead of the first updates.
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_WARMUP = os.getenv('MONGO_WARMUP', '1') == '1'
+# Replicas started often can skip creating indexes that already exist
+ENSURE_INDEXES = os.getenv('ENSURE_INDEXES', '1') == '1'
+# Seconds /ready waits for a MongoDB ping before reporting not ready
+READY_TIMEOUT = float(os.getenv('READY_TIMEOUT', 2))
+client = AsyncIOMotorClient(conn_str, minPoolSize=MONGO_MIN_POOL_SIZE, maxPoolSize=MONGO_MAX_POOL_SIZE, connect=False)
 db = client[MONGO_DB]
 
+PROJECT_CACHE_SIZE = int(os.getenv('PROJECT_CACHE_SIZE', 10000))
+PROJECT_CACHE_TTL = float(os.getenv('PROJECT_CACHE_TTL', 600))
+PROJECT_CACHE_NEGATIVE_TTL = float(os.getenv('PROJECT_CACHE_NEGATIVE_TTL', 60))
+project_cache = ProjectCache(
+    MemoryCacheBackend(PROJECT_CACHE_SIZE),
+    ttl=PROJECT_CACHE_TTL,
+    negative_ttl=PROJECT_CACHE_NEGATIVE_TTL
+)
+
+# Raid targets never change once created, so raiders opening the same link share one read
+TARGET_CACHE_SIZE = int(os.getenv('TARGET_CACHE_SIZE', 10000))
+TARGET_CACHE_TTL = float(os.getenv('TARGET_CACHE_TTL', 3600))
+target_cache = ProjectCache(
+    MemoryCacheBackend(TARGET_CACHE_SIZE),
+    ttl=TARGET_CACHE_TTL,
+    negative_ttl=PROJECT_CACHE_NEGATIVE_TTL
+)
+
+# Signs the /start payload of raid links. Defaults to a key derived from the bot token.
+DEEP_LINK_SECRET = os.getenv('DEEP_LINK_SECRET') or hashlib.sha256(f"deeplink:{TELEGRAM_BOT_TOKEN}".encode()).hexdigest()
+deep_links = DeepLinkSigner(DEEP_LINK_SECRET.encode())
+
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-ai_client = OpenAI()
+AI_BACKEND = os.getenv('AI_BACKEND', 'openai')
+AI_FAKE_LATENCY = float(os.getenv('AI_FAKE_LATENCY', 0))
+AI_MAX_IN_FLIGHT = int(os.getenv('AI_MAX_IN_FLIGHT', 8))
+AI_TIMEOUT = float(os.getenv('AI_TIMEOUT', 30))
+# Retry and token budget for generating the project's topic descriptions during setup
+AI_TOPICS_MAX_ATTEMPTS = int(os.getenv('AI_TOPICS_MAX_ATTEMPTS', 3))
+AI_TOPICS_MAX_TOKENS = int(os.getenv('AI_TOPICS_MAX_TOKENS', 2000))
+# Completions are cached on disk by prompt (e.g. topic descriptions when a project is set up again).
+# Leave AI_CACHE_PATH empty to disable.
+AI_CACHE_PATH = os.getenv('AI_CACHE_PATH', 'ai_cache')
+AI_CACHE_MAX_BYTES = int(os.getenv('AI_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', 7 * 24 * 3600))
+ai_client = AIClient(
+    make_backend(AI_BACKEND, OPENAI_API_KEY, AI_FAKE_LATENCY),
+    max_in_flight=AI_MAX_IN_FLIGHT,
+    timeout=AI_TIMEOUT,
+    cache=DiskResponseCache(AI_CACHE_PATH, AI_CACHE_MAX_BYTES, AI_CACHE_TTL) if AI_CACHE_PATH else None
+)
+ai_client.backend.on_usage = metrics.record_tokens
+ai_client.backend.on_client_created = startup.record
+
+# Posts pre-generated per raid target and handed out by handle_start
+POST_POOL_SIZE = int(os.getenv('POST_POOL_SIZE', 20))
+POST_POOL_LOW_WATERMARK = int(os.getenv('POST_POOL_LOW_WATERMARK', 5))
+# Posts within POST_SIMILARITY_THRESHOLD bits (of a 64-bit SimHash) of an earlier post of the same group are regenerated
+POST_SIMILARITY_THRESHOLD = int(os.getenv('POST_SIMILARITY_THRESHOLD', 10))
+POST_REGENERATE_ATTEMPTS = int(os.getenv('POST_REGENERATE_ATTEMPTS', 1))
+
+# Raider actions are counted in memory and written to the targets every GOAL_FLUSH_INTERVAL seconds
+GOAL_FLUSH_INTERVAL = float(os.getenv('GOAL_FLUSH_INTERVAL', 5))
+GOAL_CLAIM_CACHE_SIZE = int(os.getenv('GOAL_CLAIM_CACHE_SIZE', 100000))
+
+# /sgx_stats reads per day rollups, refreshed at most every STATS_REFRESH_INTERVAL seconds by
+# re-aggregating the raids of the last STATS_LOOKBACK_DAYS days (kept within ARCHIVE_AFTER, see below)
+STATS_REFRESH_INTERVAL = float(os.getenv('STATS_REFRESH_INTERVAL', 60))
+STATS_LOOKBACK_DAYS = int(os.getenv('STATS_LOOKBACK_DAYS', 2))
+STATS_BATCH_SIZE = int(os.getenv('STATS_BATCH_SIZE', 100))
+STATS_DAYS = int(os.getenv('STATS_DAYS', 7))
+
+# Raids are moved out of the live collections ARCHIVE_AFTER seconds after they started (0 disables),
+# in batches of ARCHIVE_BATCH_SIZE every ARCHIVE_INTERVAL seconds. They go to compressed
+# "<collection>_archive" collections ("mongo") or zstd compressed JSONL files under ARCHIVE_PATH ("file")
+ARCHIVE_AFTER = float(os.getenv('ARCHIVE_AFTER', 7 * 24 * 3600))
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', 3600))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_STORE = os.getenv('ARCHIVE_STORE', 'mongo')
+ARCHIVE_PATH = os.getenv('ARCHIVE_PATH', 'archive')
+# Targets and posts are deleted by MongoDB TARGET_TTL / POST_TTL seconds after they were created (0 keeps them).
+# Set them above ARCHIVE_AFTER to archive first: expired documents are gone for good.
+TARGET_TTL = float(os.getenv('TARGET_TTL', 0))
+POST_TTL = float(os.getenv('POST_TTL', 0))
+# A stats refresh replaces the rollups of whole days from STATS_LOOKBACK_DAYS before its previous run, out of the
+# raids still live, so those days must not hold archived raids: ARCHIVE_AFTER has to cover the lookback plus the
+# partial days at both ends. A longer lookback is shortened to fit, ARCHIVE_AFTER under two days is refused.
+STATS_LOOKBACK_LIMIT = int(ARCHIVE_AFTER // 86400) - 2
+if ARCHIVE_AFTER > 0 and STATS_LOOKBACK_DAYS > STATS_LOOKBACK_LIMIT:
+    if STATS_LOOKBACK_LIMIT < 0:
+        raise RuntimeError(f"ARCHIVE_AFTER must be 0 or at least {2 * 86400} seconds, got {ARCHIVE_AFTER:g}")
+    print(f"STATS_LOOKBACK_DAYS lowered from {STATS_LOOKBACK_DAYS} to {STATS_LOOKBACK_LIMIT} to stay within ARCHIVE_AFTER.")
+    STATS_LOOKBACK_DAYS = STATS_LOOKBACK_LIMIT
+
+# Pending unlocks are kept in the target collection ("mongo") or a local json file ("file")
+LOCK_STORE = os.getenv('LOCK_STORE', 'mongo')
+LOCK_STORE_PATH = os.getenv('LOCK_STORE_PATH', 'pending_unlocks.json')
+
+ADMIN_CACHE_TTL = float(os.getenv('ADMIN_CACHE_TTL', 300))
+ADMIN_CACHE_SIZE = int(os.getenv('ADMIN_CACHE_SIZE', 10000))
+
+# Outbound rate limits in messages per second (Telegram allows ~30/s overall, 1/s per private chat, 20/min per group)
+# TG_GLOBAL_RATE is for the whole bot: each of the WEBHOOK_WORKERS sharded workers gets an equal share of it
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', 30))
+TG_PRIVATE_CHAT_RATE = float(os.getenv('TG_PRIVATE_CHAT_RATE', 1))
+TG_GROUP_CHAT_RATE = float(os.getenv('TG_GROUP_CHAT_RATE', 20 / 60))
+
+# Updates of one chat are handled in order, at most MAILBOX_CAPACITY may wait per chat before
+# further ones are dropped (commands get a "busy" reply)
+MAILBOX_CAPACITY = int(os.getenv('MAILBOX_CAPACITY', 50))
+
+# Minimum seconds between edits of a post that is still being generated (/sgx_post)
+TG_STREAM_EDIT_INTERVAL = float(os.getenv('TG_STREAM_EDIT_INTERVAL', 1))
+
+# Serves /metrics and /traces on this port (on the webhook port in webhook mode, +1+index for sharded workers)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# Keep a span trace of the most recent updates, served on /traces
+TRACE_UPDATES = os.getenv('TRACE_UPDATES', '') == '1'
+if TRACE_UPDATES:
+    metrics.enable_tracing()
+
+# "polling" or "webhook". In webhook mode updates are sharded by chat_id over WEBHOOK_WORKERS
+# processes (0 handles them in the front process). Leave WEBHOOK_URL unset to serve local replays only.
+# Only POSTs carrying WEBHOOK_SECRET are accepted. With WEBHOOK_URL set and no WEBHOOK_SECRET a random
+# one is generated for each start and registered with set_webhook; local replays need WEBHOOK_SECRET.
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 0))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+
+# Incoming updates are recorded, anonymised, to RECORD_UPDATES_PATH (sharded workers add their index) for
+# bench.replay, keeping RECORD_UPDATES_SAMPLE of the chats. Leave the path empty to record nothing.
+RECORD_UPDATES_PATH = os.getenv('RECORD_UPDATES_PATH', '')
+RECORD_UPDATES_SAMPLE = float(os.getenv('RECORD_UPDATES_SAMPLE', 1))
+# Key of the hash that replaces user and chat IDs in recordings
+RECORD_UPDATES_SECRET = os.getenv('RECORD_UPDATES_SECRET') or hashlib.sha256(f"record:{DEEP_LINK_SECRET}".encode()).hexdigest()
+
+# Conversations are journaled to CHAT_STATES_PATH.log/.snapshot (sharded workers add their index)
+# and dropped after CHAT_STATES_TTL seconds without activity. Leave the path empty to keep them in memory only.
+CHAT_STATES_PATH = os.getenv('CHAT_STATES_PATH', 'chat_states')
+CHAT_STATES_TTL = float(os.getenv('CHAT_STATES_TTL', 24 * 3600))
+CHAT_STATES_FSYNC = os.getenv('CHAT_STATES_FSYNC', '') == '1'
 
 # Dictionary to store the state and data for each chat
-chat_states = {}
+chat_states = JournaledStates(ttl=CHAT_STATES_TTL, fsync=CHAT_STATES_FSYNC)
+router = StateRouter(chat_states)
 
 # Define states
 AWAITING_COMMAND, AWAITING_PROJECT_NAME, AWAITING_PROJECT_DESCRIPTION, AWAITING_WEBSITE, AWAITING_X_HANDLE, AWAITING_TAGS = range(0, 6)
 AWAITING_X_TARGET_LINK, AWAITING_LOCK_DURATION= range(6, 8)
 AWAITING_ITEM_TO_EDIT, AWAITING_NEW_VALUE = range(8, 10)
-GENERATING_POST = range(10, 10)
+GENERATING_POST = 10
 
 #################################################################
 #                                                               #
 #                   SHILLGENX DB OPERATIONS                     #
 #                                                               #
 #################################################################
+@instrument('db')
 async def db_add_project(project: Project):
+    new_project = None
     try:
-        project_dict = asdict(project)
-        del project_dict['_id']
-        
-        if await db_get_project(project_dict["group_chat_id"]):
-            raise Exception("A project for this group chat already exists.")
+        project_dict = project_codec.encode(project)
 
+        # insert_one fills in project_dict['_id'], so there is no need to read the document back.
+        # Duplicates are rejected by the unique index on group_chat_id (see db/indexes.py).
         collection = db["project"]
-        result = await collection.insert_one(project_dict)
-        new_project_id = result.inserted_id
-        new_project = await collection.find_one({'_id': new_project_id})
+        await collection.insert_one(project_dict)
+        project._id = project_dict['_id']
+        new_project = project
+        await project_cache.put(project.group_chat_id, new_project)
+    except DuplicateKeyError:
+        raise ValueError("A project for this group chat already exists.")
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('db_add_project', e)
 
     return new_project
 
-async def db_get_project(telegram_chat_id: str) -> Dict:
+@instrument('db')
+async def db_load_project(telegram_chat_id: str) -> Project:
+    collection = db["project"]
+    return project_codec.decode(await collection.find_one({"group_chat_id": telegram_chat_id}))
+
+@instrument('db')
+async def db_get_project(telegram_chat_id: str) -> Project:
+    project = None
     try:
-        collection = db["project"]
-        project = await collection.find_one({"group_chat_id": telegram_chat_id})
+        project = await project_cache.get(telegram_chat_id, db_load_project)
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('db_get_project', e)
     return project
 
+@instrument('db')
 async def db_delete_project(telegram_chat_id: str) -> bool:
     try:
         collection = db["project"]
         result = await collection.delete_one({"group_chat_id": telegram_chat_id})
+        await project_cache.invalidate(telegram_chat_id)
         if result.deleted_count > 0:
             return True
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('db_delete_project', e)
     return False
 
+@instrument('db')
 async def db_edit_project(group_chat_id: str, field: str, new_value: str):
     try:
         query = {"group_chat_id": group_chat_id}
@@ -85,31 +273,68 @@ async def db_edit_project(group_chat_id: str, field: str, new_value: str):
 
         collection = db["project"]
         result = await collection.update_one(query, updates)
+        await project_cache.invalidate(group_chat_id)
         return result
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('db_edit_project', e)
 
+@instrument('db')
 async def db_add_target(target: ShillgenXTarget):
+    new_target = None
     try:
-        target_dict = asdict(target)
-        del target_dict['_id']
+        target.created_at = datetime.now(timezone.utc)
+        target_dict = target_codec.encode(target)
 
         collection = db["target"]
-        result = await collection.insert_one(target_dict)
-        new_target_id = result.inserted_id
-        new_target = await collection.find_one({'_id': new_target_id})
+        await collection.insert_one(target_dict)
+        target._id = target_dict['_id']
+        new_target = target
+        await target_cache.put(str(target._id), new_target)
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('db_add_target', e)
 
     return new_target
 
-async def db_get_target(object_id: str) -> Dict:
+@instrument('db')
+async def db_add_targets(targets: List[ShillgenXTarget]) -> List[ShillgenXTarget]:
+    """ Insert several targets with a single insert_many
+    """
+    created = []
     try:
+        now = datetime.now(timezone.utc)
+        for target in targets:
+            target.created_at = now
+        target_dicts = [target_codec.encode(target) for target in targets]
+
         collection = db["target"]
-        object_id = ObjectId(object_id)
-        target = await collection.find_one({"_id": object_id})
+        await collection.insert_many(target_dicts)
+        for target, target_dict in zip(targets, target_dicts):
+            target._id = target_dict['_id']
+            await target_cache.put(str(target._id), target)
+        created = targets
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('db_add_targets', e)
+
+    return created
+
+@instrument('db')
+async def db_find_projects_by_x_handle(x_handle: str) -> List[Project]:
+    collection = db["project"]
+    cursor = collection.find({"x_handle": x_handle})
+    return [project_codec.decode(doc) async for doc in cursor]
+
+@instrument('db')
+async def db_load_target(object_id: str) -> ShillgenXTarget:
+    collection = db["target"]
+    return target_codec.decode(await collection.find_one({"_id": ObjectId(object_id)}))
+
+@instrument('db')
+async def db_get_target(object_id: str) -> ShillgenXTarget:
+    target = None
+    try:
+        target = await target_cache.get(str(object_id), db_load_target)
+    except Exception as e:
+        log_error('db_get_target', e)
     return target
 
 #################################################################
@@ -117,13 +342,14 @@ async def db_get_target(object_id: str) -> Dict:
 #                       TEST FUNCTIONS                          #
 #                                                               #
 #################################################################
-MONGODB_COLLECTIONS = [schema.name for schema in Schemas]
+MONGODB_COLLECTIONS = [schema.name for schema in Schemas] + ['raid_stats', 'raid_stats_state']
 @bot.message_handler(commands=['dropcollections'])
+@instrument('handler')
 async def handle_drop_collection(message):
     for c in MONGODB_COLLECTIONS:
         collection = db[c]
         collection.drop()
-    await bot.send_message(message.chat.id, "Collections dropped.")
+    await tg_send_message(message.chat.id, "Collections dropped.")
 
 
 #################################################################
@@ -131,78 +357,213 @@ async def handle_drop_collection(message):
 #                      HELPER FUNCTIONS                         #
 #                                                               #
 #################################################################
+@instrument('tg')
+async def tg_get_admin_ids(chat_id):
+    chat_administrators = await bot.get_chat_administrators(chat_id)
+    return [admin.user.id for admin in chat_administrators]
+
+admin_cache = AdminCache(tg_get_admin_ids, ttl=ADMIN_CACHE_TTL, max_chats=ADMIN_CACHE_SIZE)
+
+sender = SendQueue(
+    bot.send_message,
+    global_rate=TG_GLOBAL_RATE,
+    private_rate=TG_PRIVATE_CHAT_RATE,
+    group_rate=TG_GROUP_CHAT_RATE
+)
+
+@instrument('tg')
+async def tg_send_message(chat_id, text, **kwargs):
+    """ Every outbound message goes through `sender`, which applies the rate limits
+    """
+    return await sender.send_message(chat_id, text, **kwargs)
+
 async def is_user_admin(chat_id, user_id):
     try:
-        chat_administrators = await bot.get_chat_administrators(chat_id)
-        return any(admin.user.id == user_id for admin in chat_administrators)
+        return await admin_cache.is_admin(chat_id, user_id)
     except Exception as e:
-        print(f"Error checking admin status: {e}")
+        log_error('is_user_admin', e)
         return False
 
 def is_permission_granted():
     return True
 
+@instrument('tg')
 async def tg_lock_chat(chat_id):
     try:
         permissions = types.ChatPermissions(can_send_messages=False)
-        await bot.set_chat_permissions(chat_id, permissions)
+        await sender.call(chat_id, bot.set_chat_permissions, chat_id, permissions, priority=PRIORITY_CONTROL)
     except Exception as e:
-        print(f"ShillgenX must be an admin")
+        # Usually ShillgenX is not an admin of the chat
+        log_error('tg_lock_chat', e)
+        raise
 
+@instrument('tg')
 async def tg_unlock_chat(chat_id):
     try:
         permissions = types.ChatPermissions(can_send_messages=True)
-        await bot.set_chat_permissions(chat_id, permissions)
+        await sender.call(chat_id, bot.set_chat_permissions, chat_id, permissions, priority=PRIORITY_CONTROL)
     except Exception as e:
-        print(f"ShillgenX must be an admin")
-    
+        log_error('tg_unlock_chat', e)
+        # lock_scheduler tries again later
+        raise
 
-async def tg_lock_chat_for(chat_id, duration_min):
-    try:
-        await tg_lock_chat(chat_id)
 
-        if duration_min > 0:
-            await asyncio.sleep(duration_min * 60)
-            await tg_unlock_chat(chat_id)
+@instrument('tg')
+async def tg_end_lock(chat_id):
+    await tg_unlock_chat(chat_id)
+    print("Shill session ended. Chat unlocked.")
 
+lock_scheduler = LockScheduler(
+    FileLockStore(LOCK_STORE_PATH) if LOCK_STORE == 'file' else MongoLockStore(db["target"]),
+    on_due=tg_end_lock
+)
+
+@instrument('tg')
+async def tg_lock_chat_for(chat_id, duration_min, target_id=None):
+    """ Lock the chat and return immediately. The unlock is handed to lock_scheduler,
+        which persists it so it still happens after a restart.
+    """
+    try:
+        await tg_lock_chat(chat_id)
+    except Exception:
+        # Already logged. The unlock is still scheduled in case the lock went through anyway
+        pass
+
+    if duration_min > 0:
+        try:
+            await lock_scheduler.schedule(chat_id, time.time() + duration_min * 60, target_id)
+        except Exception as e:
+            log_error('tg_lock_chat_for', e)
+
+@instrument('tg')
+async def tg_notify_goal_reached(target: ShillgenXTarget, kind: str, count: int):
+    await tg_send_message(target.group_chat_id, f"Raid goal reached: {count} {kind} on {target.x_target_link}")
+
+goal_tracker = GoalTracker(db["target"], tg_notify_goal_reached, flush_interval=GOAL_FLUSH_INTERVAL)
+# (target, goal, user) already counted, so tapping a button twice only counts once
+goal_claims = MemoryCacheBackend(GOAL_CLAIM_CACHE_SIZE)
+
+raid_stats = RaidStats(db["target"], db["raid_stats"], db["raid_stats_state"], lookback_days=STATS_LOOKBACK_DAYS,
+                       refresh_interval=STATS_REFRESH_INTERVAL, batch_size=STATS_BATCH_SIZE)
+
+async def db_rollup_before_archive(targets: List[Dict]):
+    # Stats of archived raids only live on in the rollups
+    for group_chat_id in {target['group_chat_id'] for target in targets}:
+        await raid_stats.refresh(group_chat_id, force=True)
+
+archiver = Archiver(
+    db["target"],
+    db["post"],
+    FileArchiveStore(ARCHIVE_PATH) if ARCHIVE_STORE == 'file' else MongoArchiveStore(db),
+    archive_after=ARCHIVE_AFTER,
+    interval=ARCHIVE_INTERVAL,
+    batch_size=ARCHIVE_BATCH_SIZE,
+    before_archive=db_rollup_before_archive
+)
+
+def goal_keyboard(target_id):
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    keyboard.add(*(types.InlineKeyboardButton(f"I did: {kind}", callback_data=f"goal:{target_id}:{kind}") for kind in GOAL_KINDS))
+    return keyboard
+
+@instrument('tg')
+async def tg_lock_chats_for(targets: List[ShillgenXTarget]):
+    """ tg_lock_chat_for() over many chats: the locks go out concurrently through
+        `sender` and the unlocks are persisted with one store write.
+    """
+    # Failed locks are logged by tg_lock_chat, their unlocks are scheduled all the same
+    await asyncio.gather(*(tg_lock_chat(target.group_chat_id) for target in targets), return_exceptions=True)
+    now = time.time()
+    try:
+        await lock_scheduler.schedule_many([(target.group_chat_id, now + target.lock_duration * 60, target._id)
+                                            for target in targets])
     except Exception as e:
-        print(f"ShillgenX must be an admin")
+        log_error('tg_lock_chats_for', e)
 
 #################################################################
 #                                                               #
 #                      OPENAI FUNCTIONS                         #
 #                                                               #
 #################################################################
-async def ai_send_prompt(prompt: str):
-    chat_completion = ai_client.chat.completions.create(
-        model="gpt-3.5-turbo-1106",
-        messages=[{"role": "user", "content": prompt}],
-        response_format={"type": "json_object"},
-        max_tokens=1000
-    )
-    return chat_completion.choices[0].message.content
+@instrument('ai')
+async def ai_send_prompt(prompt: str, max_tokens: int = 1000, use_cache: bool = True):
+    # Awaits the completion without blocking the event loop. Raises asyncio.TimeoutError after AI_TIMEOUT.
+    # use_cache=False asks the model again even if the same prompt was answered before.
+    return await ai_client.send_prompt(prompt, max_tokens=max_tokens, use_cache=use_cache)
 
+@instrument('ai')
 async def ai_prefill_topics(project: Project, topics: Dict[str, str]):
-    """ Generate initial/sample descriptions of the topics
+    """ Generate initial/sample descriptions of the topics.
+        Topics that already have a valid description are kept and only the others are requested.
+        Raises IncompleteGenerationError (a ValueError) with the partial result when the budget runs out.
     """
-    prompt = "Act as the project owner and based on the following project description:\"\n{}\"\nWrite descriptions (20 to 25 words each) for the following JSON keys: {}".format(project.description, ", ".join(topics.keys()))
-    response = await ai_send_prompt(prompt)
-    # TODO: Verify if all required fields are present. If not, do it again.
-    topics_json = json.loads(response)
-    return topics_json
+    def build_prompt(keys):
+        return "Act as the project owner and based on the following project description:\"\n{}\"\nWrite descriptions (20 to 25 words each) for the following JSON keys: {}".format(project.description, ", ".join(keys))
+
+    return await generate_fields(
+        ai_send_prompt,
+        build_prompt,
+        topics.keys(),
+        known=topics,
+        max_attempts=AI_TOPICS_MAX_ATTEMPTS,
+        max_total_tokens=AI_TOPICS_MAX_TOKENS
+    )
 
-async def ai_generate_post(project: Project, mood: str, topic: str):
-    """ Generate the post
+def ai_post_prompt(project: Project, mood: str, topic: str, reply: str = "Reply with the tweet only.") -> str:
+    """ Prompt for a post, `reply` says what the answer should look like
     """
-    prompt = f"Write a {gen_details.mood} shill tweet about the project's {topic} in JSON format with one key 'post'. Use the following info:\
+    return f"Write a {mood} shill tweet about the project's {topic}. {reply} Use the following info:\
 Project Name: {project.name}\
 Project Description: {project.description}\
 Tags: {project.tags}\
 Tweet Topic: {topic}\
 Topic Details: {project.topics[topic]}"
+
+@instrument('ai')
+async def ai_generate_post(project: Project, mood: str, topic: str) -> str:
+    """ Generate the post
+    """
+    prompt = ai_post_prompt(project, mood, topic, "Reply in JSON format with one key 'post'.")
     # TODO: Verify if all required fields are present. If not, do it again.
-    response = await ai_send_prompt(prompt)
-    return response
+    # Every post should be new, a cached one would repeat an earlier raid
+    response = await ai_send_prompt(prompt, use_cache=False)
+    return json.loads(response)['post']
+
+@instrument('ai')
+async def ai_stream_post(project: Project, mood: str, topic: str):
+    """ ai_generate_post() that yields the post as the model writes it. Holds one of the
+        AI_MAX_IN_FLIGHT slots and raises asyncio.TimeoutError after AI_TIMEOUT, like ai_send_prompt().
+    """
+    start = time.perf_counter()
+    first = True
+    chunks = ai_client.stream_prompt(ai_post_prompt(project, mood, topic), max_tokens=300)
+    try:
+        async for chunk in chunks:
+            if first:
+                metrics.call_seconds.observe(time.perf_counter() - start, kind='ai', name='ai_stream_post_first_chunk')
+                first = False
+            yield chunk
+    finally:
+        # Gives the AI_MAX_IN_FLIGHT slot back right away when the caller stops early
+        await chunks.aclose()
+
+def make_similarity_index():
+    # Imported here: numpy is only needed by the processes that generate posts
+    from ai.similarity import SimHashIndex
+    return SimHashIndex(threshold=POST_SIMILARITY_THRESHOLD)
+
+async def ai_generate_pool_post(project: Project, topic: str, mood: str) -> str:
+    return await ai_generate_post(project, mood, topic)
+
+post_pool = PostPool(
+    db["post"],
+    db["post_refill"],
+    ai_generate_pool_post,
+    size=POST_POOL_SIZE,
+    low_watermark=POST_POOL_LOW_WATERMARK,
+    similarity=make_similarity_index if POST_SIMILARITY_THRESHOLD >= 0 else None,
+    regenerate_attempts=POST_REGENERATE_ATTEMPTS
+)
 
 #################################################################
 #                                                               #
@@ -212,18 +573,36 @@ Topic Details: {project.topics[topic]}"
 
 ########################## General ##############################
 @bot.message_handler(commands=['cancel'])
+@instrument('handler')
 async def handle_cancel(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if not chat_states[chat_id]['current_user'] == user_id:
+    chat_state = chat_states.get(chat_id)
+    if chat_state is None:
+        await tg_send_message(chat_id, "Nothing to cancel.")
+        return
+    if not chat_state['current_user'] == user_id:
         return
 
     del chat_states[chat_id]
-    await bot.send_message(chat_id, "Operation canceled.")
+    await tg_send_message(chat_id, "Operation canceled.")
+
+@bot.chat_member_handler()
+@instrument('handler')
+async def handle_chat_member(update):
+    # Only promotions and demotions change the cached admin set
+    if update.old_chat_member.status in ADMIN_STATUSES or update.new_chat_member.status in ADMIN_STATUSES:
+        admin_cache.invalidate(update.chat.id)
+
+@bot.my_chat_member_handler()
+@instrument('handler')
+async def handle_my_chat_member(update):
+    admin_cache.invalidate(update.chat.id)
 
 ##################### Account Creation ##########################
 @bot.message_handler(commands=['sgx_setup'])
+@instrument('handler')
 async def handle_shillgenx_setup(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
@@ -233,7 +612,7 @@ async def handle_shillgenx_setup(message):
         return
 
     if await db_get_project(chat_id):
-        await bot.send_message(chat_id, "A ShillgenX account is already setup in this chat. Use /sgx_delete to start over.")
+        await tg_send_message(chat_id, "A ShillgenX account is already setup in this chat. Use /sgx_delete to start over.")
         return
 
     chat_states[chat_id] = {
@@ -241,9 +620,10 @@ async def handle_shillgenx_setup(message):
         'current_user': user_id,
         'project': Project()
         }
-    await bot.send_message(chat_id, "What is the name of your project?")
+    await tg_send_message(chat_id, "What is the name of your project?")
 
 @bot.message_handler(commands=['sgx_delete'])
+@instrument('handler')
 async def handle_shillgenx_delete(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
@@ -253,117 +633,174 @@ async def handle_shillgenx_delete(message):
         return
 
     if await db_delete_project(chat_id):
-        await bot.send_message(chat_id, "ShillgenX account successfully deleted.")
+        await tg_send_message(chat_id, "ShillgenX account successfully deleted.")
         return
-    await bot.send_message(chat_id, "Something went wrong.")
+    await tg_send_message(chat_id, "Something went wrong.")
 
-@bot.message_handler(func=lambda message: chat_states.get(message.chat.id, {}).get('state') == AWAITING_PROJECT_NAME)
+@router.route(AWAITING_PROJECT_NAME)
+@instrument('handler')
 async def process_project_name(message):
-    user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if chat_states[chat_id]['current_user'] and not chat_states[chat_id]['current_user'] == user_id:
-        return
-
     try:
         chat_states[chat_id]['project'].set_name(message.text)
         chat_states[chat_id]['project_name'] = message.text
         chat_states[chat_id]['state'] = AWAITING_PROJECT_DESCRIPTION
-        await bot.send_message(chat_id, "Tell me about your project! You can include details about the following (the more I know, the better):\nProduct\nTechnology\nSecurity\nNarrative\nRoadmap\nUse Case\nCommunity\n")
+        await tg_send_message(chat_id, "Tell me about your project! You can include details about the following (the more I know, the better):\nProduct\nTechnology\nSecurity\nNarrative\nRoadmap\nUse Case\nCommunity\n")
     except ValueError as e:
-        await bot.send_message(chat_id, f"{e}")
+        await tg_send_message(chat_id, f"{e}")
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('process_project_name', e)
 
-@bot.message_handler(func=lambda message: chat_states.get(message.chat.id, {}).get('state') == AWAITING_PROJECT_DESCRIPTION)
+@router.route(AWAITING_PROJECT_DESCRIPTION)
+@instrument('handler')
 async def process_project_description(message):
-    user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if chat_states[chat_id]['current_user'] and not chat_states[chat_id]['current_user'] == user_id:
-        return
-
     try:
         chat_states[chat_id]['project'].set_description(message.text)
         chat_states[chat_id]['project_description'] = message.text
         chat_states[chat_id]['state'] = AWAITING_X_HANDLE
-        await bot.send_message(chat_id, "What is the X Handle of your project?\nExample:\n@example")
+        await tg_send_message(chat_id, "What is the X Handle of your project?\nExample:\n@example")
     except ValueError as e:
-        await bot.send_message(chat_id, f"{e}")
+        await tg_send_message(chat_id, f"{e}")
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('process_project_description', e)
 
-@bot.message_handler(func=lambda message: chat_states.get(message.chat.id, {}).get('state') == AWAITING_X_HANDLE)
+@router.route(AWAITING_X_HANDLE)
+@instrument('handler')
 async def process_x_handle(message):
-    user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if chat_states[chat_id]['current_user'] and not chat_states[chat_id]['current_user'] == user_id:
-        return
     try:
         chat_states[chat_id]['project'].set_x_handle(message.text)
         chat_states[chat_id]['x_handle'] = message.text
         chat_states[chat_id]['state'] = AWAITING_WEBSITE
-        await bot.send_message(chat_id, "What is your project's website?\nExample:\nwww.example.ai")
+        await tg_send_message(chat_id, "What is your project's website?\nExample:\nwww.example.ai")
     except ValueError as e:
-        await bot.send_message(chat_id, f"{e}")
+        await tg_send_message(chat_id, f"{e}")
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('process_x_handle', e)
 
-@bot.message_handler(func=lambda message: chat_states.get(message.chat.id, {}).get('state') == AWAITING_WEBSITE)
+@router.route(AWAITING_WEBSITE)
+@instrument('handler')
 async def process_website(message):
-    user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if chat_states[chat_id]['current_user'] and not chat_states[chat_id]['current_user'] == user_id:
-        return
-
     try:
         chat_states[chat_id]['project'].set_website(message.text)
         chat_states[chat_id]['website'] = message.text
         chat_states[chat_id]['state'] = AWAITING_TAGS
-        await bot.send_message(chat_id, "What are some tags for your project?\nExample:\n$EXAMPLE, #EXAMPLE")
+        await tg_send_message(chat_id, "What are some tags for your project?\nExample:\n$EXAMPLE, #EXAMPLE")
     except ValueError as e:
-        await bot.send_message(chat_id, f"{e}")
+        await tg_send_message(chat_id, f"{e}")
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('process_website', e)
 
-@bot.message_handler(func=lambda message: chat_states.get(message.chat.id, {}).get('state') == AWAITING_TAGS)
+@router.route(AWAITING_TAGS)
+@instrument('handler')
 async def process_tags(message):
-    user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if chat_states[chat_id]['current_user'] and not chat_states[chat_id]['current_user'] == user_id:
-        return
-
     # Get the telegram group invite link
     try:
         invite_link = await bot.export_chat_invite_link(chat_id)
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('process_tags', e)
 
     try:
         chat_states[chat_id]['project'].set_tags_string(message.text)
         chat_states[chat_id]['project'].set_group_chat_id(chat_id)
         chat_states[chat_id]['project'].set_telegram(invite_link)
         chat_states[chat_id]['tags'] = message.text
-        await bot.send_message(chat_id, "Creating your account. Please wait...")
-
-        initial_topics = await ai_prefill_topics(chat_states[chat_id]['project'], chat_states[chat_id]['project'].topics)
+        await tg_send_message(chat_id, "Creating your account. Please wait...")
+
+        try:
+            initial_topics = await ai_prefill_topics(chat_states[chat_id]['project'], chat_states[chat_id]['project'].topics)
+        except IncompleteGenerationError as e:
+            # Keep what was generated so sending the tags again only asks for the rest
+            chat_states[chat_id]['project'].set_topics({**chat_states[chat_id]['project'].topics, **e.partial})
+            raise
         chat_states[chat_id]['project'].set_topics(initial_topics)
 
         created_project = await db_add_project(chat_states[chat_id]['project'])
         print(created_project)
 
         del chat_states[chat_id]
-        await bot.send_message(chat_id, "Thank you! Your account has been created. Now use /shillx to start raiding!")
+        await tg_send_message(chat_id, "Thank you! Your account has been created. Now use /shillx to start raiding!")
     except ValueError as e:
-        await bot.send_message(chat_id, f"{e}")
+        await tg_send_message(chat_id, f"{e}")
+    except asyncio.TimeoutError:
+        await tg_send_message(chat_id, "Account creation timed out. Please send your tags again.")
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('process_tags', e)
+
+###################### Account Editing ##########################
+# Item name -> (project field, setter used to validate the new value)
+EDITABLE_ITEMS = {
+    'name': ('name', Project.set_name),
+    'description': ('description', Project.set_description),
+    'x_handle': ('x_handle', Project.set_x_handle),
+    'website': ('website', Project.set_website),
+    'tags': ('tags', Project.set_tags_string),
+}
+
+@bot.message_handler(commands=['sgx_edit'])
+@instrument('handler')
+async def handle_shillgenx_edit(message):
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+
+    if not await is_user_admin(chat_id, user_id):
+        return
+
+    if not await db_get_project(chat_id):
+        await tg_send_message(chat_id, "No ShillgenX account is setup in this chat. Use /sgx_setup first.")
+        return
+
+    chat_states[chat_id] = {
+        'state': AWAITING_ITEM_TO_EDIT,
+        'current_user': user_id,
+        'project': Project()
+        }
+    await tg_send_message(chat_id, f"What would you like to edit?\n{', '.join(EDITABLE_ITEMS)}")
+
+@router.route(AWAITING_ITEM_TO_EDIT)
+@instrument('handler')
+async def process_item_to_edit(message):
+    chat_id = message.chat.id
+
+    item = message.text.strip().lower()
+    if item not in EDITABLE_ITEMS:
+        await tg_send_message(chat_id, f"Unknown item. Choose one of: {', '.join(EDITABLE_ITEMS)}")
+        return
+
+    chat_states[chat_id]['item'] = item
+    chat_states[chat_id]['state'] = AWAITING_NEW_VALUE
+    await tg_send_message(chat_id, f"What is the new {item}?")
+
+@router.route(AWAITING_NEW_VALUE)
+@instrument('handler')
+async def process_new_value(message):
+    chat_id = message.chat.id
+
+    try:
+        field, setter = EDITABLE_ITEMS[chat_states[chat_id]['item']]
+        project = chat_states[chat_id]['project']
+        setter(project, message.text)
+
+        await db_edit_project(chat_id, field, getattr(project, field))
+
+        del chat_states[chat_id]
+        await tg_send_message(chat_id, "Your account has been updated.")
+    except ValueError as e:
+        await tg_send_message(chat_id, f"{e}")
+    except Exception as e:
+        log_error('process_new_value', e)
 
 ################### Shill Target Generation ###################
 @bot.message_handler(commands=['shillx'])
+@instrument('handler')
 async def process_shillx(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
@@ -381,73 +818,473 @@ async def process_shillx(message):
             'current_user': user_id,
             'target': ShillgenXTarget()
             }
-        await bot.send_message(chat_id, "Paste the X link to the raid target!")
+        await tg_send_message(chat_id, "Paste the X link to the raid target!")
     except telebot.apihelper.ApiException as api_exception:
         print(f"Telegram API error occurred: {api_exception}")
     except telebot.apihelper.ApiTelegramException as api_telegram_exception:
         print(f"Telegram specific API error occurred: {api_telegram_exception}")
     except Exception as e:
-        print("An error occurred:", e)
+        log_error('process_shillx', e)
 
-@bot.message_handler(func=lambda message: chat_states.get(message.chat.id, {}).get('state') == AWAITING_X_TARGET_LINK)
+@router.route(AWAITING_X_TARGET_LINK)
+@instrument('handler')
 async def process_x_target_link(message):
-    user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if chat_states[chat_id]['current_user'] and not chat_states[chat_id]['current_user'] == user_id:
-        return
-
     try:
         chat_states[chat_id]['target'].set_x_target_link(message.text)
         chat_states[chat_id]['state'] = AWAITING_LOCK_DURATION
-        await bot.delete_message(chat_id, message.message_id)
-        await bot.send_message(chat_id, f"How many minutes to lock chat for?")
+        await sender.call(chat_id, bot.delete_message, chat_id, message.message_id)
+        await tg_send_message(chat_id, f"How many minutes to lock chat for?")
     except ValueError as e:
-        await bot.send_message(chat_id, f"{e}")
+        await tg_send_message(chat_id, f"{e}")
     except Exception as e:
-        print(f"An error occured: {e}")
+        log_error('process_x_target_link', e)
 
-@bot.message_handler(func=lambda message: chat_states.get(message.chat.id, {}).get('state') == AWAITING_LOCK_DURATION)
+@router.route(AWAITING_LOCK_DURATION)
+@instrument('handler')
 async def process_duration(message):
-    user_id = message.from_user.id
     chat_id = message.chat.id
 
-    if chat_states[chat_id]['current_user'] and not chat_states[chat_id]['current_user'] == user_id:
-        return
-
     try:
         project = await db_get_project(chat_id)
-        chat_states[chat_id]['target'].set_project_id(project['_id'])
+        chat_states[chat_id]['target'].set_project_id(project._id)
         chat_states[chat_id]['target'].set_group_chat_id(chat_id)
         chat_states[chat_id]['target'].set_lock_duration(int(message.text))
 
         created_target = await db_add_target(chat_states[chat_id]['target'])
 
-        await bot.send_message(chat_id, f"https://t.me/shillgenx_test_bot?start={created_target['group_chat_id']}_{created_target['_id']}")
-        await bot.send_message(chat_id, f"Chat is locked for {created_target['lock_duration']} minute(s).")
+        payload = deep_links.sign(created_target._id, created_target.group_chat_id)
+        await tg_send_message(chat_id, f"https://t.me/shillgenx_test_bot?start={payload}")
+        await tg_send_message(chat_id, f"Chat is locked for {created_target.lock_duration} minute(s).")
+
+        post_pool.fill(created_target, project)
+        goal_tracker.track(created_target)
+        await tg_lock_chat_for(chat_id, created_target.lock_duration, created_target._id)
 
-        await tg_lock_chat_for(chat_id, created_target['lock_duration'])
-        print("Shill session ended. Chat unlocked.")
-        
         del chat_states[chat_id]
     except Exception as e:
-        print("An error occurred:", e)
+        log_error('process_duration', e)
+
+@bot.message_handler(commands=['sgx_raid_all'])
+@instrument('handler')
+async def handle_raid_all(message):
+    """ /sgx_raid_all <X link> <minutes>
+        Launches the raid in every group whose project has this group's X handle
+        and where the sender is an admin.
+    """
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    start = time.perf_counter()
+
+    if not await is_user_admin(chat_id, user_id):
+        return
+
+    try:
+        args = message.text.split()
+        if len(args) != 3:
+            raise ValueError("Usage: /sgx_raid_all <X link> <minutes>")
+        template = ShillgenXTarget()
+        template.set_x_target_link(args[1])
+        try:
+            template.set_lock_duration(int(args[2]))
+        except ValueError:
+            raise ValueError("Invalid lock duration, must be a positive number.")
+
+        project = await db_get_project(chat_id)
+        if project is None:
+            raise ValueError("No ShillgenX account is setup in this chat. Use /sgx_setup first.")
+
+        projects = await db_find_projects_by_x_handle(project.x_handle) if project.x_handle else [project]
+        allowed = await asyncio.gather(*(is_user_admin(p.group_chat_id, user_id) for p in projects))
+        projects = [p for p, is_admin in zip(projects, allowed) if is_admin]
+
+        targets = [ShillgenXTarget(project_id=p._id, group_chat_id=p.group_chat_id, x_target_link=template.x_target_link,
+                                   lock_duration=template.lock_duration) for p in projects]
+        targets = await db_add_targets(targets)
+        if not targets:
+            await tg_send_message(chat_id, "Something went wrong.")
+            return
+
+        async def announce(target):
+            payload = deep_links.sign(target._id, target.group_chat_id)
+            await tg_send_message(target.group_chat_id, f"https://t.me/shillgenx_test_bot?start={payload}")
+            await tg_send_message(target.group_chat_id, f"Chat is locked for {target.lock_duration} minute(s).")
+
+        for target, p in zip(targets, projects):
+            post_pool.fill(target, p)
+            goal_tracker.track(target)
+        await asyncio.gather(tg_lock_chats_for(targets), *(announce(target) for target in targets))
+
+        elapsed = time.perf_counter() - start
+        await tg_send_message(chat_id, f"Raid launched in {len(targets)} group(s) in {elapsed:.2f}s.")
+    except ValueError as e:
+        await tg_send_message(chat_id, f"{e}")
+    except Exception as e:
+        log_error('handle_raid_all', e)
+
+@bot.message_handler(commands=['sgx_post'])
+@instrument('handler')
+async def handle_generate_post(message):
+    """ /sgx_post [topic]
+        Writes a new post for the chat's project, shown while it is being generated.
+    """
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+
+    # Every post costs a completion
+    if not await is_user_admin(chat_id, user_id):
+        return
+
+    if chat_id in chat_states:
+        await tg_send_message(chat_id, "Please finish the current operation first or use /cancel.")
+        return
+
+    project = await db_get_project(chat_id)
+    if project is None:
+        await tg_send_message(chat_id, "No ShillgenX account is setup in this chat. Use /sgx_setup first.")
+        return
+
+    args = message.text.split(maxsplit=1)
+    topic = args[1].strip().lower() if len(args) > 1 else random.choice(list(project.topics))
+    if topic not in project.topics:
+        await tg_send_message(chat_id, f"Unknown topic. Choose one of: {', '.join(project.topics)}")
+        return
+
+    # Not journaled: after a crash mid-stream the chat must not stay busy
+    chat_states.put_transient(chat_id, {
+        'state': GENERATING_POST,
+        'current_user': user_id
+        })
+    stream = MessageStream(
+        lambda text: sender.call(chat_id, bot.send_message, chat_id, text),
+        lambda sent, text: sender.call(chat_id, bot.edit_message_text, text, chat_id, sent.message_id),
+        min_interval=TG_STREAM_EDIT_INTERVAL
+    )
+    try:
+        await stream.run(ai_stream_post(project, random.choice(POST_MOODS), topic))
+    except asyncio.TimeoutError:
+        await tg_send_message(chat_id, "Post generation timed out. Please try again.")
+    except Exception as e:
+        log_error('handle_generate_post', e)
+    finally:
+        chat_states.pop(chat_id, None)
+
+@bot.message_handler(commands=['sgx_stats'])
+@instrument('handler')
+async def handle_stats(message):
+    """ /sgx_stats [days]
+        Raids, goals and actions counted per day.
+    """
+    chat_id = message.chat.id
+
+    try:
+        args = message.text.split()
+        days = int(args[1]) if len(args) > 1 else STATS_DAYS
+        if days <= 0:
+            raise ValueError("Usage: /sgx_stats [days]")
+
+        await raid_stats.refresh(chat_id)
+        rows = [row async for row in raid_stats.days(chat_id, days)]
+        await tg_send_message(chat_id, format_summary(rows))
+    except ValueError:
+        await tg_send_message(chat_id, "Usage: /sgx_stats [days]")
+    except Exception as e:
+        log_error('handle_stats', e)
+
+@bot.message_handler(commands=['sgx_stats_export'])
+@instrument('handler')
+async def handle_stats_export(message):
+    """ /sgx_stats_export
+        The whole history of /sgx_stats as a CSV file. Rows are written to a temporary
+        file as the cursor returns them, so the history is never held in memory.
+    """
+    chat_id = message.chat.id
+
+    if not await is_user_admin(chat_id, message.from_user.id):
+        return
+
+    try:
+        await raid_stats.refresh(chat_id)
+        with tempfile.TemporaryFile() as f:
+            f.write(f"{CSV_HEADER}\n".encode())
+            async for row in raid_stats.days(chat_id):
+                f.write(f"{csv_line(row)}\n".encode())
+            f.seek(0)
+            await sender.call(chat_id, bot.send_document, chat_id, f, visible_file_name='raid_stats.csv')
+    except Exception as e:
+        log_error('handle_stats_export', e)
 
 @bot.message_handler(commands=['start'])
+@instrument('handler')
 async def handle_start(message):
     args = message.text.split(maxsplit=1)
     if len(args) > 1:
-        params = args[1].split('_')
-        group_chat_id = params[0]
-        shill_target_id = params[1]
-        target_object = await db_get_target(shill_target_id)
-        project_object = await db_get_project(target_object["group_chat_id"])
-        await bot.send_message(message.chat.id, f"Target Details: {target_object}\nProject Details: {project_object}")
+        # Forged or edited links are rejected without a database lookup
+        ids = deep_links.verify(args[1].strip())
+        if ids is None:
+            await tg_send_message(message.chat.id, "This raid link is not valid.")
+            return
+
+        shill_target_id, group_chat_id = ids
+
+        async def load_raid():
+            # Both reads are cached and only needed to generate more posts
+            target, project = await asyncio.gather(db_get_target(shill_target_id), db_get_project(group_chat_id))
+            return None if target is None or project is None else (target, project)
+
+        # A ready post carries the target link, so a cold link costs the claim's round trip alone
+        post = await post_pool.claim(shill_target_id, message.from_user.id, load_raid)
+        if post is None:
+            if await load_raid() is None:
+                await tg_send_message(message.chat.id, "This raid is no longer available.")
+            else:
+                await tg_send_message(message.chat.id, "No posts are ready yet. Please open the link again in a moment.")
+            return
+        x_target_link = post.x_target_link
+        if not x_target_link:
+            # Posts generated before the link was copied onto them
+            target = await db_get_target(shill_target_id)
+            x_target_link = target.x_target_link if target else ''
+        await tg_send_message(message.chat.id, f"{post.shill}\n\nRaid target: {x_target_link}",
+                              reply_markup=goal_keyboard(shill_target_id))
     else:
-        await bot.send_message(message.chat.id, "Welcome to the bot!")
+        await tg_send_message(message.chat.id, "Welcome to the bot!")
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith('goal:'))
+@instrument('handler')
+async def handle_goal_action(call):
+    try:
+        _, target_id, kind = call.data.split(':')
+        target = await db_get_target(target_id) if kind in GOAL_KINDS else None
+        if target is None:
+            await bot.answer_callback_query(call.id, "This raid is no longer available.")
+            return
+
+        if not await goal_claims.add(('goal', target_id, kind, call.from_user.id), True, TARGET_CACHE_TTL):
+            await bot.answer_callback_query(call.id, "Already counted.")
+            return
+        count = goal_tracker.record(target, kind)
+        await bot.answer_callback_query(call.id, f"Counted! {kind}: {count}/{target.goals.get(kind, 0)}")
+    except Exception as e:
+        log_error('handle_goal_action', e)
+
+######################## Conversations ########################
+# Registered last so that commands always take precedence over an ongoing conversation
+@bot.message_handler(func=lambda message: True)
+@instrument('handler')
+async def handle_conversation(message):
+    await router.dispatch(message)
+    # Routed handlers update the conversation in place
+    chat_states.commit(message.chat.id)
+
+######################## Mailboxes ############################
+# Every update goes through its chat's mailbox, see tg/mailbox.py. Polling, the webhook and the
+# benchmarks all call bot.process_new_updates, so it is replaced here for all of them.
+process_updates_now = bot.process_new_updates
+
+async def handle_update(update):
+    await process_updates_now([update])
+
+mailboxes = ChatMailboxes(handle_update, capacity=MAILBOX_CAPACITY)
+
+async def tg_reply_busy(update):
+    # Only commands get an answer, plain chatter in a busy group is dropped silently
+    message = update.message
+    if message is not None and message.text and message.text.startswith('/'):
+        await tg_send_message(message.chat.id, "I'm busy right now, please try again in a moment.")
+
+def deep_link_group(payload):
+    verified = deep_links.verify(payload)
+    return verified[1] if verified else None
+
+update_recorder = UpdateRecorder(RECORD_UPDATES_SECRET.encode(), resolve_start=deep_link_group, sample=RECORD_UPDATES_SAMPLE)
+
+async def process_new_updates(updates):
+    """ Queue each update in its chat's mailbox and wait until they were all handled
+    """
+    waiting = []
+    busy = []
+    startup.update_received()
+    for update in updates:
+        if update_recorder.is_open:
+            update_recorder.record(update)
+        done = mailboxes.submit(chat_id_of(update), update)
+        if done is None:
+            busy.append(update)
+        else:
+            waiting.append(done)
+    await asyncio.gather(*waiting, *(tg_reply_busy(update) for update in busy), return_exceptions=True)
+
+bot.process_new_updates = process_new_updates
+
+######################## Metrics ##############################
+metrics.registry.add_collector('shillgenx_admin_cache', lambda: admin_cache.stats())
+metrics.registry.add_collector('shillgenx_project_cache', lambda: project_cache.stats())
+metrics.registry.add_collector('shillgenx_target_cache', lambda: target_cache.stats())
+metrics.registry.add_collector('shillgenx_send_queue', lambda: sender.stats())
+metrics.registry.add_collector('shillgenx_ai', lambda: ai_client.stats())
+metrics.registry.add_collector('shillgenx_ai_cache', lambda: ai_client.cache.stats() if ai_client.cache else {})
+metrics.registry.add_collector('shillgenx_mailboxes', lambda: mailboxes.stats())
+metrics.registry.add_collector('shillgenx_chat_states', lambda: chat_states.stats())
+metrics.registry.add_collector('shillgenx_post_similarity', lambda: post_pool.similarity.stats() if post_pool.similarity else {})
+metrics.registry.add_collector('shillgenx_goal_tracker', lambda: goal_tracker.stats())
+metrics.registry.add_collector('shillgenx_startup', lambda: startup.stats())
+metrics.registry.add_collector('shillgenx_update_recorder', lambda: update_recorder.stats())
+metrics.registry.add_collector('shillgenx_archiver', lambda: archiver.stats())
+metrics.registry.add_collector('shillgenx_lock_scheduler', lambda: lock_scheduler.stats())
+
+async def start_db(create_indexes=ENSURE_INDEXES):
+    if MONGO_WARMUP:
+        with startup.stage('mongo warm-up'):
+            # Concurrent pings each take a connection of their own
+            await asyncio.gather(*(db.command('ping') for _ in range(max(1, MONGO_MIN_POOL_SIZE))))
+    if create_indexes:
+        with startup.stage('ensure_indexes'):
+            await ensure_indexes(db, ttls={'target': TARGET_TTL, 'post': POST_TTL})
+
+async def db_check_ready():
+    try:
+        await asyncio.wait_for(db.command('ping'), READY_TIMEOUT)
+        return {'mongo': True}
+    except Exception:
+        return {'mongo': False}
+
+async def start_chat_states(path):
+    if path:
+        start = time.perf_counter()
+        with startup.stage('chat_states'):
+            chat_states.open(path)
+        print(f"Loaded {len(chat_states)} conversation(s) in {(time.perf_counter() - start) * 1000:.1f}ms.")
+    await chat_states.start()
+
+def start_recorder(path):
+    if path:
+        update_recorder.open(path)
+        print(f"Recording updates to {path}.")
+
+async def start_archiver():
+    # Only the main process archives, sharded workers would race on the same targets
+    if ARCHIVE_AFTER > 0:
+        await archiver.start()
+
+# Keeps references to background tasks so they are not garbage collected
+background_tasks = set()
+
+def preload_ai_client():
+    """ Build the AI backend's client in a thread once startup is done, so the first
+        generation does not block the event loop on importing it
+    """
+    task = asyncio.create_task(asyncio.to_thread(getattr, ai_client.backend, 'client', None))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def start_metrics(port):
+    if port:
+        await start_app(startup.add_readiness(metrics.make_app(), db_check_ready), WEBHOOK_HOST, port)
+
+######################## Webhook Mode #########################
+# Keeps references to in-flight update tasks so they are not garbage collected
+pending_updates = set()
+
+@instrument('update')
+async def tg_process_raw_update(raw: str):
+    await bot.process_new_updates([types.Update.de_json(raw)])
+
+def run_webhook_worker(index, shard_count, worker_queue):
+    asyncio.run(webhook_worker(index, shard_count, worker_queue))
+
+async def webhook_worker(index, shard_count, worker_queue):
+    await start_metrics(METRICS_PORT and METRICS_PORT + 1 + index)
+    # The front process already created the indexes
+    await start_db(create_indexes=False)
+    # Every worker has its own send queue, together they stay within the bot's global rate
+    sender.set_global_rate(TG_GLOBAL_RATE / max(1, shard_count))
+    await lock_scheduler.start(owns=lambda chat_id: shard_for(chat_id, shard_count) == index)
+    await goal_tracker.start()
+    await start_chat_states(CHAT_STATES_PATH and f"{CHAT_STATES_PATH}.{index}")
+    start_recorder(RECORD_UPDATES_PATH and f"{RECORD_UPDATES_PATH}.{index}")
+    startup.mark_ready()
+    preload_ai_client()
+    await serve_queue(worker_queue, tg_process_raw_update)
+    await goal_tracker.stop()
+    await chat_states.stop()
+    update_recorder.close()
+
+async def run_webhook():
+    webhook_secret = WEBHOOK_SECRET
+    if not webhook_secret:
+        if not WEBHOOK_URL:
+            raise RuntimeError("WEBHOOK_SECRET is required to serve local replays")
+        # Telegram is told the new one by set_webhook below
+        webhook_secret = secrets.token_urlsafe(32)
+
+    dispatcher = None
+    if WEBHOOK_WORKERS > 0:
+        dispatcher = ShardedDispatcher(run_webhook_worker, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+        dispatcher.start()
+
+        async def accept(chat_id, raw):
+            return dispatcher.dispatch(chat_id, raw)
+    else:
+        await lock_scheduler.start()
+        await goal_tracker.start()
+        await start_chat_states(CHAT_STATES_PATH)
+        start_recorder(RECORD_UPDATES_PATH)
+        preload_ai_client()
+
+        async def accept(chat_id, raw):
+            task = asyncio.create_task(tg_process_raw_update(raw))
+            pending_updates.add(task)
+            task.add_done_callback(pending_updates.discard)
+            return True
+
+    await start_archiver()
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=webhook_secret, allowed_updates=util.update_types)
+
+    app = startup.add_readiness(make_app(WEBHOOK_PATH, accept, webhook_secret), db_check_ready)
+    if METRICS_PORT:
+        metrics.make_app(app)
+    runner = await start_app(app, WEBHOOK_HOST, WEBHOOK_PORT)
+    print(f"Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} with {WEBHOOK_WORKERS} worker(s).")
+    startup.mark_ready()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await archiver.stop()
+        await mailboxes.join()
+        await goal_tracker.stop()
+        await chat_states.stop()
+        update_recorder.close()
+        if dispatcher:
+            dispatcher.stop()
 
 async def run_bot():
-    await bot.polling()
+    await start_db()
+    if BOT_MODE == 'webhook':
+        await run_webhook()
+        return
+
+    await lock_scheduler.start()
+    await goal_tracker.start()
+    await start_chat_states(CHAT_STATES_PATH)
+    start_recorder(RECORD_UPDATES_PATH)
+    await start_archiver()
+    await start_metrics(METRICS_PORT)
+    startup.mark_ready()
+    preload_ai_client()
+    try:
+        # chat_member updates are not delivered unless asked for explicitly
+        await bot.polling(allowed_updates=util.update_types)
+    finally:
+        # Finish queued updates, then write the last buffered goal progress and a final conversation snapshot
+        await archiver.stop()
+        await mailboxes.join()
+        await goal_tracker.stop()
+        await chat_states.stop()
+        update_recorder.close()
 
 if __name__ == '__main__':
     asyncio.run(run_bot())
@@ -0,0 +1,148 @@
+""" Cold start profiling and readiness.
+
+    With profiling on (STARTUP_PROFILE=1), every module imported afterwards
+    is timed like `python -X importtime` does, stages wrapped in `stage()`
+    and clients built on first use (`record()`) are timed too, and the lot
+    is printed once the process reports ready, followed by the time to the
+    first update. Readiness is served on /ready by add_readiness().
+"""
+import contextlib
+import sys
+import time
+from importlib.machinery import ExtensionFileLoader, SourceFileLoader, SourcelessFileLoader
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Loaders created per module, whose exec_module can be wrapped on the instance
+TIMED_LOADERS = (SourceFileLoader, SourcelessFileLoader, ExtensionFileLoader)
+
+started = time.perf_counter()
+stages: Dict[str, float] = {}
+ready_after: Optional[float] = None
+first_update_after: Optional[float] = None
+profiler: Optional['ImportProfiler'] = None
+
+
+class ImportProfiler:
+    """ sys.meta_path hook recording the seconds each module took to execute,
+        minus the modules it imported in turn.
+    """
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self._children: List[float] = []
+
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if isinstance(spec.loader, TIMED_LOADERS):
+            spec.loader.exec_module = self._timed(name, spec.loader.exec_module)
+        return spec
+
+    def _timed(self, name: str, exec_module):
+        def timed_exec_module(module):
+            self._children.append(0.0)
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.seconds[name] = elapsed - self._children.pop()
+                if self._children:
+                    self._children[-1] += elapsed
+        return timed_exec_module
+
+    def packages(self) -> List[Tuple[str, float, str]]:
+        """ (top level package, seconds, its slowest module), slowest first """
+        totals: Dict[str, float] = {}
+        slowest: Dict[str, str] = {}
+        for name, seconds in self.seconds.items():
+            package = name.split('.', 1)[0]
+            totals[package] = totals.get(package, 0.0) + seconds
+            if seconds > self.seconds.get(slowest.get(package), -1.0):
+                slowest[package] = name
+        return sorted(((package, seconds, slowest[package]) for package, seconds in totals.items()),
+                      key=lambda item: -item[1])
+
+
+def profile_imports():
+    global profiler
+    if profiler is None:
+        profiler = ImportProfiler()
+        sys.meta_path.insert(0, profiler)
+
+
+def record(name: str, seconds: float):
+    stages[name] = stages.get(name, 0.0) + seconds
+    if profiler is not None and ready_after is not None:
+        # Built after startup, on first use
+        print(f"Startup profile: {name} took {seconds * 1000:.1f}ms on first use.")
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def mark_ready():
+    global ready_after
+    if ready_after is None:
+        ready_after = time.perf_counter() - started
+        if profiler is not None:
+            print(report())
+
+
+def is_ready() -> bool:
+    return ready_after is not None
+
+
+def update_received():
+    global first_update_after
+    if first_update_after is None:
+        first_update_after = time.perf_counter() - started
+        if profiler is not None:
+            print(f"Startup profile: first update after {first_update_after * 1000:.1f}ms.")
+
+
+def report(top: int = 15) -> str:
+    lines = [f"Startup profile: ready after {ready_after * 1000:.1f}ms."]
+    if profiler is not None:
+        packages = profiler.packages()
+        lines.append(f"Imports: {sum(seconds for _, seconds, _ in packages) * 1000:.1f}ms in {len(profiler.seconds)} modules")
+        lines += [f"  {package:<24} {seconds * 1000:>8.1f}ms  (slowest: {module})"
+                  for package, seconds, module in packages[:top]]
+    lines.append("Stages:")
+    lines += [f"  {name:<24} {seconds * 1000:>8.1f}ms" for name, seconds in stages.items()]
+    return '\n'.join(lines)
+
+
+def stats():
+    return {
+        'ready': int(is_ready()),
+        'ready_seconds': ready_after or 0.0,
+        'first_update_seconds': first_update_after or 0.0,
+    }
+
+
+def add_readiness(app, check: Optional[Callable[[], Awaitable[Dict[str, bool]]]] = None):
+    """ Add /ready to an aiohttp app: 200 once mark_ready() was called and every
+        check `check()` returns passed, 503 otherwise.
+    """
+    from aiohttp import web
+
+    async def handle_ready(request):
+        checks = {'started': is_ready()}
+        if checks['started'] and check is not None:
+            checks.update(await check())
+        return web.json_response(checks, status=200 if all(checks.values()) else 503)
+
+    app.router.add_get('/ready', handle_ready)
+    return app
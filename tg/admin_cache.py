@@ -0,0 +1,49 @@
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, FrozenSet, Iterable
+
+ADMIN_STATUSES = ('creator', 'administrator')
+
+
+class AdminCache:
+    """ Set of administrator user IDs per chat, so admin checks skip the
+        get_chat_administrators round trip.
+
+        Entries expire after `ttl` seconds and the least recently used chat is
+        evicted once more than `max_chats` are cached. `invalidate()` is called
+        from the chat_member handlers when someone's admin status changes.
+    """
+    def __init__(self, fetch: Callable[[int], Awaitable[Iterable[int]]], ttl: float = 300, max_chats: int = 10000):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get_admins(self, chat_id: int) -> FrozenSet[int]:
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(chat_id)
+            return entry[1]
+
+        self.misses += 1
+        admins = frozenset(await self.fetch(chat_id))
+        self._entries[chat_id] = (time.monotonic() + self.ttl, admins)
+        self._entries.move_to_end(chat_id)
+        while len(self._entries) > self.max_chats:
+            self._entries.popitem(last=False)
+        return admins
+
+    async def is_admin(self, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.get_admins(chat_id)
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
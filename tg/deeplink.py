@@ -0,0 +1,50 @@
+import base64
+import hashlib
+import hmac
+import struct
+from typing import Optional, Tuple
+
+# Telegram accepts up to 64 characters of A-Z, a-z, 0-9, _ and - after ?start=
+MAX_PAYLOAD_LENGTH = 64
+
+_IDS = struct.Struct('>12sq')
+_SIGNATURE_BYTES = 10
+
+
+class DeepLinkSigner:
+    """ Raid link payloads that carry the target ID and its group chat ID.
+
+        The payload is base64url(ObjectId bytes | group_chat_id | truncated HMAC-SHA256),
+        40 characters in all, so /start can reject a forged or edited link
+        before touching the database and knows which project to use without
+        reading the target first.
+    """
+    def __init__(self, secret: bytes):
+        if not secret:
+            raise ValueError("A deep link secret is required.")
+        self.secret = secret
+
+    def _signature(self, ids: bytes) -> bytes:
+        return hmac.new(self.secret, ids, hashlib.sha256).digest()[:_SIGNATURE_BYTES]
+
+    def sign(self, target_id, group_chat_id: int) -> str:
+        ids = _IDS.pack(bytes.fromhex(str(target_id)), group_chat_id)
+        return base64.urlsafe_b64encode(ids + self._signature(ids)).decode().rstrip('=')
+
+    def verify(self, payload: str) -> Optional[Tuple[str, int]]:
+        """ (target ID as hex, group chat ID) or None if the payload is malformed or not signed by us
+        """
+        if len(payload) > MAX_PAYLOAD_LENGTH:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+        except ValueError:
+            return None
+        if len(raw) != _IDS.size + _SIGNATURE_BYTES:
+            return None
+
+        ids, signature = raw[:_IDS.size], raw[_IDS.size:]
+        if not hmac.compare_digest(signature, self._signature(ids)):
+            return None
+        target_id, group_chat_id = _IDS.unpack(ids)
+        return target_id.hex(), group_chat_id
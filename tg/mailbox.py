@@ -0,0 +1,100 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+# Update fields whose object carries the chat, then those that only carry the sender
+CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+               'my_chat_member', 'chat_member', 'chat_join_request')
+USER_FIELDS = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query', 'poll_answer')
+
+
+def chat_id_of(update) -> int:
+    """ tg.webhook.update_chat_id() for a parsed telebot Update
+    """
+    for field in CHAT_FIELDS:
+        value = getattr(update, field, None)
+        if value is not None:
+            return value.chat.id
+    callback_query = getattr(update, 'callback_query', None)
+    if callback_query is not None:
+        if callback_query.message is not None:
+            return callback_query.message.chat.id
+        return callback_query.from_user.id
+    for field in USER_FIELDS:
+        value = getattr(update, field, None)
+        if value is not None:
+            user = getattr(value, 'from_user', None) or getattr(value, 'user', None)
+            return user.id if user is not None else 0
+    return 0
+
+
+class ChatMailboxes:
+    """ One mailbox per chat, drained in order by a single actor task.
+
+        Updates of the same chat are handled one after the other, so handlers
+        never interleave on that chat's state, while different chats run in
+        parallel. A mailbox holds at most `capacity` waiting items and
+        `submit()` refuses more, leaving the caller to drop the update or
+        answer that the bot is busy. Actors exit once their mailbox is empty,
+        so idle chats cost nothing.
+    """
+    def __init__(self, handle: Callable[[object], Awaitable[None]], capacity: int = 50):
+        self.handle = handle
+        self.capacity = capacity
+        self._mailboxes: Dict[int, deque] = {}
+        self._actors: Dict[int, asyncio.Task] = {}
+        self.processed = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._mailboxes)
+
+    def depth(self) -> int:
+        return sum(len(mailbox) for mailbox in self._mailboxes.values())
+
+    def submit(self, chat_id: int, item) -> Optional[asyncio.Future]:
+        """ Queue `item` for its chat. Returns a future resolved once it was handled,
+            or None if the chat's mailbox is full.
+        """
+        mailbox = self._mailboxes.get(chat_id)
+        if mailbox is None:
+            mailbox = self._mailboxes[chat_id] = deque()
+        elif len(mailbox) >= self.capacity:
+            self.rejected += 1
+            return None
+
+        done = asyncio.get_running_loop().create_future()
+        mailbox.append((item, done))
+        if chat_id not in self._actors:
+            self._actors[chat_id] = asyncio.create_task(self._run(chat_id, mailbox))
+        return done
+
+    async def _run(self, chat_id: int, mailbox: deque):
+        try:
+            while mailbox:
+                item, done = mailbox.popleft()
+                try:
+                    await self.handle(item)
+                except Exception as e:
+                    print(f"An error occured: {e}")
+                finally:
+                    self.processed += 1
+                    if not done.done():
+                        done.set_result(None)
+        finally:
+            del self._actors[chat_id]
+            del self._mailboxes[chat_id]
+            # Cancelled mid-way: release whoever is still waiting
+            for _, done in mailbox:
+                if not done.done():
+                    done.cancel()
+
+    async def join(self):
+        """ Wait until every mailbox is empty
+        """
+        while self._actors:
+            await asyncio.gather(*list(self._actors.values()), return_exceptions=True)
+
+    def stats(self):
+        return {'chats': len(self._mailboxes), 'depth': self.depth(), 'processed': self.processed,
+                'rejected': self.rejected}
@@ -0,0 +1,196 @@
+""" Recording of live updates, replayed against the fakes by bench.replay.
+
+    Every line of a recording is {"t": epoch seconds, "update": {...}} with
+    only the fields of the update the replay needs (FIELDS), anonymised:
+    integer IDs go through a keyed hash (negative IDs stay negative, so
+    groups stay groups), string IDs are replaced by a keyed digest, names by
+    a placeholder, and the letters and digits of free text are masked while
+    its length, commands and plain numbers are kept. Anything else (entity
+    URLs, contacts, locations, venues, media...) is dropped, so a message
+    without text or caption is replayed as one without content.
+    A /start deep link is recorded as "/start @<anonymised group chat id>" so
+    the replay can substitute the link its own run produced for that group.
+"""
+import hashlib
+import hmac
+import json
+import re
+import time
+from typing import Callable, Dict, Optional
+
+from tg.webhook import update_chat_id
+
+# Update fields recorded. Their telebot objects keep the JSON they were parsed from.
+RECORDED_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query')
+# What is kept of each object an update is made of, per field: KEEP as is, ID hashed,
+# TEXT masked, a placeholder string, or the name of the object type of the value (or of its items)
+KEEP, ID, TEXT = object(), object(), object()
+FIELDS = {
+    'update': {'update_id': ID, 'message': 'message', 'edited_message': 'message', 'channel_post': 'message',
+               'edited_channel_post': 'message', 'callback_query': 'callback_query'},
+    'message': {'message_id': ID, 'message_thread_id': ID, 'is_topic_message': KEEP, 'from': 'user', 'sender_chat': 'chat',
+                'date': KEEP, 'edit_date': KEEP, 'chat': 'chat', 'reply_to_message': 'message', 'text': TEXT,
+                'entities': 'entity', 'caption': TEXT, 'caption_entities': 'entity', 'new_chat_members': 'user',
+                'left_chat_member': 'user', 'group_chat_created': KEEP, 'supergroup_chat_created': KEEP,
+                'migrate_to_chat_id': ID, 'migrate_from_chat_id': ID},
+    'user': {'id': ID, 'is_bot': KEEP, 'first_name': 'Anon'},
+    'chat': {'id': ID, 'type': KEEP, 'title': 'Group', 'is_forum': KEEP},
+    # Without url (text links) and custom_emoji_id
+    'entity': {'type': KEEP, 'offset': KEEP, 'length': KEEP, 'user': 'user'},
+    'callback_query': {'id': ID, 'from': 'user', 'message': 'message', 'chat_instance': ID, 'data': KEEP},
+}
+START_REFERENCE = '@'
+URL = re.compile(r'^(https?://[^/\s]+)(\S*)$')
+NUMBER = re.compile(r'^[\d,.]+$')
+LETTERS_AND_DIGITS = re.compile(r'[^\W\d_]')
+DIGITS = re.compile(r'\d')
+
+
+def anonymise_id(value: int, secret: bytes) -> int:
+    digest = int.from_bytes(hmac.new(secret, str(value).encode(), hashlib.sha256).digest()[:8], 'big')
+    if value < 0:
+        # Shaped like a supergroup ID
+        return -(10 ** 12 + digest % 10 ** 12)
+    return 1 + digest % (1 << 40)
+
+
+def mask_word(word: str) -> str:
+    if NUMBER.match(word):
+        # Durations, goals and other plain numbers
+        return word
+    url = URL.match(word)
+    if url:
+        # Keep the host, so X links stay X links
+        return url.group(1) + mask_word(url.group(2))
+    return DIGITS.sub('0', LETTERS_AND_DIGITS.sub('x', word))
+
+
+def mask_text(text: str) -> str:
+    """ Same length, same commands and numbers, no readable words
+    """
+    words = text.split(' ')
+    first = 0
+    if words and words[0].startswith('/'):
+        # The command itself, without a @botname suffix
+        words[0] = words[0].split('@', 1)[0]
+        first = 1
+    return ' '.join(words[:first] + [mask_word(word) for word in words[first:]])
+
+
+def anonymise_string_id(value: str, secret: bytes) -> str:
+    return hmac.new(secret, value.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def _anonymise(value: Dict, kind: str, secret: bytes) -> Dict:
+    result = {}
+    for key, rule in FIELDS[kind].items():
+        item = value.get(key)
+        if item is None:
+            continue
+        if rule is KEEP:
+            result[key] = item
+        elif rule is ID:
+            if isinstance(item, int) and not isinstance(item, bool):
+                result[key] = anonymise_id(item, secret)
+            elif isinstance(item, str):
+                result[key] = anonymise_string_id(item, secret)
+        elif rule is TEXT:
+            if isinstance(item, str):
+                result[key] = mask_text(item)
+        elif rule in FIELDS:
+            if isinstance(item, list):
+                result[key] = [_anonymise(element, rule, secret) for element in item if isinstance(element, dict)]
+            elif isinstance(item, dict):
+                result[key] = _anonymise(item, rule, secret)
+        else:
+            # Placeholder
+            result[key] = rule
+    return result
+
+
+def anonymise_update(update: Dict, secret: bytes, resolve_start: Optional[Callable[[str], Optional[int]]] = None) -> Dict:
+    """ Anonymised copy of a raw update. `resolve_start(payload)` returns the group chat ID
+        a /start payload links to, or None.
+    """
+    message = update.get('message')
+    start_group = None
+    if resolve_start is not None and message and message.get('text', '').startswith('/start '):
+        start_group = resolve_start(message['text'].split(maxsplit=1)[1])
+
+    anonymised = _anonymise(update, 'update', secret)
+    if start_group is not None:
+        anonymised['message']['text'] = f"/start {START_REFERENCE}{anonymise_id(start_group, secret)}"
+    return anonymised
+
+
+class UpdateRecorder:
+    """ Appends the updates handed to `record()` to a JSONL file once `open()`ed.
+
+        Updates are sampled per chat (a raider's /start counts towards the
+        group it links to), so conversations and the deep link bursts they
+        cause are kept whole. Lines are buffered and flushed at most every
+        `flush_interval` seconds and on close(). Update types without the raw
+        JSON in their telebot object (chat member changes, inline queries...)
+        are counted as skipped.
+    """
+    def __init__(self, secret: bytes, resolve_start: Optional[Callable[[str], Optional[int]]] = None,
+                 sample: float = 1.0, flush_interval: float = 1.0):
+        self.secret = secret
+        self.resolve_start = resolve_start
+        self.sample = sample
+        self.flush_interval = flush_interval
+        self._file = None
+        self._flushed_at = 0.0
+        self.recorded = 0
+        self.skipped = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    def open(self, path: str):
+        self._file = open(path, 'a')
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _sampled(self, raw: Dict) -> bool:
+        if self.sample >= 1:
+            return True
+        chat_id = update_chat_id(raw)
+        text = raw.get('message', {}).get('text', '')
+        if self.resolve_start is not None and text.startswith('/start '):
+            chat_id = self.resolve_start(text.split(maxsplit=1)[1]) or chat_id
+        digest = hmac.new(self.secret, str(chat_id).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:4], 'big') < self.sample * (1 << 32)
+
+    def record(self, update) -> bool:
+        """ Record a telebot Update. Returns False if it was sampled out or skipped.
+        """
+        if self._file is None:
+            return False
+        raw = {'update_id': update.update_id}
+        for field in RECORDED_FIELDS:
+            value = getattr(update, field, None)
+            if value is not None and getattr(value, 'json', None) is not None:
+                raw[field] = value.json
+                break
+        else:
+            self.skipped += 1
+            return False
+        if not self._sampled(raw):
+            return False
+
+        line = json.dumps({'t': round(time.time(), 3), 'update': anonymise_update(raw, self.secret, self.resolve_start)})
+        self._file.write(f"{line}\n")
+        self.recorded += 1
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self._file.flush()
+            self._flushed_at = time.monotonic()
+        return True
+
+    def stats(self):
+        return {'open': int(self.is_open), 'recorded': self.recorded, 'skipped': self.skipped}
@@ -0,0 +1,37 @@
+from typing import Awaitable, Callable, Dict
+
+
+class StateRouter:
+    """ Routes a message to the handler registered for its chat's conversation state.
+
+        Replaces one `message_handler(func=...)` predicate per state, which
+        pyTelegramBotAPI evaluates one after the other, with a single lookup in
+        `states` and a dict dispatch, so the cost per update does not grow with
+        the number of states. Messages from anyone but the chat's
+        `current_user` are ignored here instead of in every handler.
+    """
+    def __init__(self, states: Dict):
+        self.states = states
+        self._routes: Dict[int, Callable[..., Awaitable]] = {}
+
+    def route(self, state: int):
+        def decorator(handler):
+            self._routes[state] = handler
+            return handler
+        return decorator
+
+    async def dispatch(self, message) -> bool:
+        chat_state = self.states.get(message.chat.id)
+        if chat_state is None:
+            return False
+
+        handler = self._routes.get(chat_state.get('state'))
+        if handler is None:
+            return False
+
+        current_user = chat_state.get('current_user')
+        if current_user and current_user != message.from_user.id:
+            return False
+
+        await handler(message)
+        return True
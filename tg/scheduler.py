@@ -0,0 +1,234 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+# (chat_id, unlock_at as epoch seconds, reference to the raid target or None)
+PendingUnlock = Tuple[int, float, Optional[object]]
+
+
+#################################################################
+#                           STORES                              #
+#################################################################
+class MongoLockStore:
+    """ Keeps pending unlocks on the raid's own document in the `target`
+        collection as an `unlock_at` field, removed once the chat is unlocked.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def save(self, chat_id: int, unlock_at: float, ref=None):
+        # A newer raid replaces whatever was pending for the chat
+        await self.remove_many([chat_id])
+        if ref is not None:
+            when = datetime.fromtimestamp(unlock_at, tz=timezone.utc)
+            await self.collection.update_one({"_id": ref}, {"$set": {"unlock_at": when}})
+
+    async def save_many(self, pending: List[PendingUnlock]):
+        """ save() for many chats in two round trips """
+        await self.remove_many([chat_id for chat_id, _, _ in pending])
+        requests = [UpdateOne({"_id": ref}, {"$set": {"unlock_at": datetime.fromtimestamp(unlock_at, tz=timezone.utc)}})
+                    for _, unlock_at, ref in pending if ref is not None]
+        if requests:
+            await self.collection.bulk_write(requests, ordered=False)
+
+    async def remove_many(self, chat_ids: Iterable[int]):
+        await self.collection.update_many(
+            {"group_chat_id": {"$in": list(chat_ids)}, "unlock_at": {"$exists": True}},
+            {"$unset": {"unlock_at": ""}}
+        )
+
+    async def load(self) -> List[PendingUnlock]:
+        pending = []
+        cursor = self.collection.find({"unlock_at": {"$exists": True}}, {"group_chat_id": 1, "unlock_at": 1})
+        async for doc in cursor:
+            when = doc["unlock_at"]
+            if when.tzinfo is None:
+                when = when.replace(tzinfo=timezone.utc)
+            pending.append((doc["group_chat_id"], when.timestamp(), doc["_id"]))
+        return pending
+
+
+class FileLockStore:
+    """ Local stand-in for the Mongo store. The whole table is rewritten
+        atomically on every change, which is fine for a single process.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._pending: Dict[int, Tuple[float, Optional[str]]] = {}
+
+    async def save(self, chat_id: int, unlock_at: float, ref=None):
+        self._pending[chat_id] = (unlock_at, None if ref is None else str(ref))
+        self._flush()
+
+    async def save_many(self, pending: List[PendingUnlock]):
+        for chat_id, unlock_at, ref in pending:
+            self._pending[chat_id] = (unlock_at, None if ref is None else str(ref))
+        self._flush()
+
+    async def remove_many(self, chat_ids: Iterable[int]):
+        for chat_id in chat_ids:
+            self._pending.pop(chat_id, None)
+        self._flush()
+
+    async def load(self) -> List[PendingUnlock]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            rows = json.load(f)
+        self._pending = {chat_id: (unlock_at, ref) for chat_id, unlock_at, ref in rows}
+        return [(chat_id, unlock_at, ref) for chat_id, (unlock_at, ref) in self._pending.items()]
+
+    def _flush(self):
+        rows = [[chat_id, unlock_at, ref] for chat_id, (unlock_at, ref) in self._pending.items()]
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(rows, f)
+        os.replace(tmp_path, self.path)
+
+
+#################################################################
+#                         SCHEDULER                             #
+#################################################################
+class LockScheduler:
+    """ Unlocks chats when their raid ends.
+
+        Pending unlocks live in a min-heap ordered by due time and a single
+        background task sleeps until the earliest one, so scheduling is
+        O(log n) and no coroutine is held per raid. Rescheduling a chat leaves
+        its old heap entry behind, which is skipped when popped. Every change
+        is written to `store` and re-armed by `start()`, so chats that came
+        due while the bot was down are unlocked together on startup.
+
+        When `on_due` raises, the chat keeps its stored record and is tried
+        again after `retry_delay` seconds, doubling on every failure up to
+        `max_retry_delay`, so a failed unlock never leaves a chat locked for good.
+    """
+    def __init__(self, store, on_due: Callable[[int], Awaitable[None]], max_concurrent_unlocks: int = 20,
+                 retry_delay: float = 5.0, max_retry_delay: float = 3600.0):
+        self.store = store
+        self.on_due = on_due
+        self.max_concurrent_unlocks = max_concurrent_unlocks
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._heap: List[Tuple[float, int]] = []
+        self._due: Dict[int, float] = {}
+        # Consecutive failed unlocks per chat
+        self._failures: Dict[int, int] = {}
+        self.unlocked = 0
+        self.failed_unlocks = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._due)
+
+    async def start(self, owns: Optional[Callable[[int], bool]] = None):
+        """ Re-arm persisted unlocks. `owns` limits them to the chats this process
+            is responsible for when updates are sharded over several workers.
+        """
+        # Oldest first so that the newest raid wins if a chat has several pending unlocks
+        for chat_id, unlock_at, _ in sorted(await self.store.load(), key=lambda pending: pending[1]):
+            if owns is None or owns(chat_id):
+                self._arm(chat_id, unlock_at)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def schedule(self, chat_id: int, unlock_at: float, ref=None):
+        await self.store.save(chat_id, unlock_at, ref)
+        self._arm(chat_id, unlock_at)
+
+    async def schedule_many(self, pending: List[PendingUnlock]):
+        """ schedule() for several chats with a single store write """
+        await self.store.save_many(pending)
+        for chat_id, unlock_at, _ in pending:
+            self._arm(chat_id, unlock_at)
+
+    async def cancel(self, chat_id: int):
+        self._failures.pop(chat_id, None)
+        if self._due.pop(chat_id, None) is not None:
+            await self.store.remove_many([chat_id])
+
+    def _arm(self, chat_id: int, unlock_at: float, retry: bool = False):
+        if not retry:
+            # A new raid starts over with a fresh backoff
+            self._failures.pop(chat_id, None)
+        self._due[chat_id] = unlock_at
+        heapq.heappush(self._heap, (unlock_at, chat_id))
+        if self._heap[0] == (unlock_at, chat_id):
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            unlock_at, chat_id = heapq.heappop(self._heap)
+            if self._due.get(chat_id) == unlock_at:
+                del self._due[chat_id]
+                due.append(chat_id)
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due(time.time())
+            if due:
+                await self._fire(due)
+                continue
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, chat_ids: List[int]):
+        semaphore = asyncio.Semaphore(self.max_concurrent_unlocks)
+
+        async def unlock(chat_id) -> bool:
+            async with semaphore:
+                try:
+                    await self.on_due(chat_id)
+                    return True
+                except Exception as e:
+                    print(f"An error occured: {e}")
+                    return False
+
+        results = await asyncio.gather(*(unlock(chat_id) for chat_id in chat_ids))
+        unlocked = []
+        for chat_id, ok in zip(chat_ids, results):
+            if chat_id in self._due:
+                # Re-locked while we were unlocking, the new raid keeps its record
+                continue
+            if ok:
+                self._failures.pop(chat_id, None)
+                unlocked.append(chat_id)
+                continue
+            # The stored record stays, so a restart tries again as well
+            failures = self._failures[chat_id] = self._failures.get(chat_id, 0) + 1
+            self.failed_unlocks += 1
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** (failures - 1))
+            self._arm(chat_id, time.time() + delay, retry=True)
+        self.unlocked += len(unlocked)
+        if not unlocked:
+            return
+        try:
+            await self.store.remove_many(unlocked)
+        except Exception as e:
+            print(f"An error occured: {e}")
+
+    def stats(self):
+        return {
+            'pending': len(self._due),
+            'retrying': len(self._failures),
+            'unlocked': self.unlocked,
+            'failed_unlocks': self.failed_unlocks,
+        }
@@ -0,0 +1,228 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# Lower runs first. Locking and unlocking chats goes ahead of informational messages.
+PRIORITY_CONTROL = 0
+PRIORITY_INFO = 1
+
+MAX_MESSAGE_LENGTH = 4096
+MAX_RETRIES = 3
+
+
+def retry_after_of(exception: Exception) -> Optional[float]:
+    """ Seconds Telegram asked us to wait in a 429 response, None for any other error
+    """
+    result_json = getattr(exception, 'result_json', None)
+    if isinstance(result_json, dict) and result_json.get('error_code') == 429:
+        return float(result_json.get('parameters', {}).get('retry_after', 1))
+    return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """ Seconds until a token is available
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ('priority', 'method', 'args', 'kwargs', 'text', 'futures', 'queued_at', 'attempts')
+
+    def __init__(self, priority, method, args, kwargs, text=None):
+        self.priority = priority
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        # Only plain send_message jobs carry text, those are the ones that can be merged
+        self.text = text
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+class SendQueue:
+    """ Single outbound path for Telegram API calls.
+
+        Calls are queued per chat and released by one worker task within a
+        global token bucket and a per-chat bucket (stricter for groups, whose
+        chat IDs are negative). A chat only has one call in flight at a time,
+        so its messages arrive in order. Control calls jump ahead of queued
+        informational ones, consecutive plain texts to the same chat are merged
+        into one message, and 429s are retried after Telegram's retry_after.
+    """
+    def __init__(self, send_message: Callable[..., Awaitable], global_rate: float = 30, private_rate: float = 1,
+                 group_rate: float = 20 / 60, burst: float = 3, max_chat_buckets: int = 100000):
+        self.send_message_method = send_message
+        self.set_global_rate(global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_chat_buckets = max_chat_buckets
+        self._chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+        self._queues: Dict[int, List[deque]] = {}
+        self._ready: List = []
+        self._delayed: List = []
+        self._busy = set()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._inflight = set()
+        self.depth = 0
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.failed = 0
+        self.wait_seconds_total = 0.0
+
+    def set_global_rate(self, rate: float):
+        """ Change the overall rate, e.g. to split Telegram's limit between processes
+        """
+        # At least one token, or a rate below 1/s would never release a call
+        self.global_bucket = TokenBucket(rate, max(1.0, rate))
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'merged': self.merged,
+            'retried': self.retried,
+            'failed': self.failed,
+            'wait_seconds_total': self.wait_seconds_total,
+        }
+
+    async def send_message(self, chat_id: int, text: str, priority: int = PRIORITY_INFO, **kwargs):
+        job = _Job(priority, self.send_message_method, (chat_id, text), kwargs, None if kwargs else text)
+        return await self._submit(chat_id, job)
+
+    async def call(self, chat_id: int, method: Callable[..., Awaitable], *args, priority: int = PRIORITY_INFO, **kwargs):
+        return await self._submit(chat_id, _Job(priority, method, args, kwargs))
+
+    async def _submit(self, chat_id: int, job: _Job):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        queues = self._queues.get(chat_id)
+        if queues is None:
+            queues = self._queues[chat_id] = [deque(), deque()]
+        queues[job.priority].append(job)
+        self.depth += 1
+        self._make_ready(chat_id)
+        return await job.futures[0]
+
+    def _make_ready(self, chat_id: int):
+        """ Put the chat on the ready heap unless it already is or has a call in flight
+        """
+        queues = self._queues.get(chat_id)
+        if not queues or chat_id in self._busy:
+            return
+        priority = PRIORITY_CONTROL if queues[PRIORITY_CONTROL] else PRIORITY_INFO
+        if not queues[priority]:
+            return
+        self._busy.add(chat_id)
+        heapq.heappush(self._ready, (priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.burst)
+            while len(self._chat_buckets) > self.max_chat_buckets:
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            chat_wait = self._chat_bucket(chat_id).wait_time(now)
+            if chat_wait > 0:
+                heapq.heappush(self._delayed, (now + chat_wait, priority, seq, chat_id))
+                continue
+
+            global_wait = self.global_bucket.wait_time(now)
+            if global_wait > 0:
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+                await asyncio.sleep(global_wait)
+                continue
+
+            self.global_bucket.take()
+            self._chat_bucket(chat_id).take()
+            job = self._next_job(chat_id)
+            task = asyncio.create_task(self._execute(chat_id, job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    def _next_job(self, chat_id: int) -> _Job:
+        queues = self._queues[chat_id]
+        queue = queues[PRIORITY_CONTROL] if queues[PRIORITY_CONTROL] else queues[PRIORITY_INFO]
+        job = queue.popleft()
+        self.depth -= 1
+        # Fold the following plain texts into this one while they fit in a single message
+        while job.text is not None and queue and queue[0].text is not None \
+                and len(job.text) + 2 + len(queue[0].text) <= MAX_MESSAGE_LENGTH:
+            following = queue.popleft()
+            self.depth -= 1
+            self.merged += 1
+            job.text = f"{job.text}\n\n{following.text}"
+            job.args = (job.args[0], job.text)
+            job.futures.extend(following.futures)
+            self.wait_seconds_total += time.monotonic() - following.queued_at
+        self.wait_seconds_total += time.monotonic() - job.queued_at
+        return job
+
+    async def _execute(self, chat_id: int, job: _Job):
+        job.attempts += 1
+        try:
+            result = await job.method(*job.args, **job.kwargs)
+            self.sent += 1
+            for future in job.futures:
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            retry_after = retry_after_of(e)
+            if retry_after is not None and job.attempts < MAX_RETRIES:
+                self.retried += 1
+                self._queues[chat_id][job.priority].appendleft(job)
+                self.depth += 1
+                # The chat stays busy while we back off
+                await asyncio.sleep(retry_after)
+            else:
+                self.failed += 1
+                for future in job.futures:
+                    if not future.done():
+                        future.set_exception(e)
+        finally:
+            self._busy.discard(chat_id)
+            queues = self._queues.get(chat_id)
+            if queues is not None and not queues[PRIORITY_CONTROL] and not queues[PRIORITY_INFO]:
+                del self._queues[chat_id]
+            self._make_ready(chat_id)
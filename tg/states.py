@@ -0,0 +1,207 @@
+import asyncio
+import gc
+import mmap
+import os
+import pickle
+import struct
+import time
+import zlib
+from typing import Dict, Optional
+
+# Record header: payload length and its crc32
+_HEADER = struct.Struct('<II')
+_PUT, _DELETE = 0, 1
+
+
+class JournaledStates(dict):
+    """ chat_states that survive restarts.
+
+        Works as a plain dict until `open()` is called. After that every
+        assignment, deletion and `commit(chat_id)` (called once a handler has
+        mutated the entry in place) appends a pickled record to `<path>.log`.
+        Once the log holds `compact_every` records the whole dict is written to
+        `<path>.snapshot` and the log starts over, so startup reads one
+        snapshot plus a short log through mmap. A torn record at the end of
+        the log, left by a crash mid-write, is dropped.
+
+        Records are flushed to the OS on write, which survives a process crash.
+        Set `fsync` to also survive a power loss at the cost of a disk sync per
+        write. Conversations idle for longer than `ttl` seconds are dropped by
+        `expire()` and skipped when loading. Entries set with `put_transient()`
+        are never journaled, for states that must not outlive the process.
+    """
+    def __init__(self, ttl: float = 24 * 3600, compact_every: int = 10000, fsync: bool = False):
+        super().__init__()
+        self.ttl = ttl
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.path: Optional[str] = None
+        self._touched: Dict[int, float] = {}
+        self._transient = set()
+        self._log = None
+        self._records = 0
+        self._task: Optional[asyncio.Task] = None
+        self.expired = 0
+
+    #################################################################
+    #                            DICT                               #
+    #################################################################
+    def __setitem__(self, chat_id, value):
+        super().__setitem__(chat_id, value)
+        self._touched[chat_id] = time.time()
+        self._transient.discard(chat_id)
+        self._append(_PUT, chat_id, value)
+
+    def __delitem__(self, chat_id):
+        super().__delitem__(chat_id)
+        self._touched.pop(chat_id, None)
+        if chat_id in self._transient:
+            self._transient.discard(chat_id)
+        else:
+            self._append(_DELETE, chat_id, None)
+
+    def put_transient(self, chat_id, value):
+        """ Set an entry that is kept in memory only, so a restart forgets it
+        """
+        super().__setitem__(chat_id, value)
+        self._touched[chat_id] = time.time()
+        self._transient.add(chat_id)
+
+    def pop(self, chat_id, *default):
+        if chat_id not in self:
+            return super().pop(chat_id, *default)
+        value = self[chat_id]
+        del self[chat_id]
+        return value
+
+    def commit(self, chat_id):
+        """ Journal an entry that was changed in place (e.g. chat_states[chat_id]['state'] = ...)
+        """
+        if chat_id in self and chat_id not in self._transient:
+            self._touched[chat_id] = time.time()
+            self._append(_PUT, chat_id, dict.__getitem__(self, chat_id))
+
+    #################################################################
+    #                           JOURNAL                             #
+    #################################################################
+    def open(self, path: str):
+        """ Load the snapshot and log at `path` and journal every change from now on
+        """
+        self.path = path
+        # Unpickling allocates many objects at once, a GC pass every few hundred would dominate the load
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._load()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load(self):
+        now = time.time()
+        entries: Dict[int, tuple] = {}
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, 'rb') as f:
+                entries = pickle.load(f)
+
+        log_size = os.path.getsize(self._log_path) if os.path.exists(self._log_path) else 0
+        if log_size:
+            with open(self._log_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + _HEADER.size <= len(data):
+                    length, crc = _HEADER.unpack_from(data, offset)
+                    payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        break
+                    op, chat_id, touched, value = pickle.loads(payload)
+                    if op == _PUT:
+                        entries[chat_id] = (touched, value)
+                    else:
+                        entries.pop(chat_id, None)
+                    offset += _HEADER.size + length
+
+        super().clear()
+        self._touched.clear()
+        for chat_id, (touched, value) in entries.items():
+            if touched + self.ttl > now:
+                super().__setitem__(chat_id, value)
+                self._touched[chat_id] = touched
+
+        # After a crash the log is folded into a fresh snapshot, which also drops a torn
+        # last record. A clean close() leaves an empty log and nothing to do.
+        self._log = open(self._log_path, 'ab')
+        if log_size:
+            self.compact()
+
+    def compact(self):
+        """ Write every live entry to the snapshot and start an empty log
+        """
+        if self.path is None:
+            return
+        entries = {chat_id: (self._touched.get(chat_id, 0.0), value) for chat_id, value in self.items()
+                   if chat_id not in self._transient}
+        tmp_path = f"{self._snapshot_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+        self._log.truncate(0)
+        self._records = 0
+
+    def close(self):
+        if self._log is not None:
+            self.compact()
+            self._log.close()
+            self._log = None
+        self.path = None
+
+    @property
+    def _log_path(self) -> str:
+        return f"{self.path}.log"
+
+    @property
+    def _snapshot_path(self) -> str:
+        return f"{self.path}.snapshot"
+
+    def _append(self, op: int, chat_id, value):
+        if self._log is None:
+            return
+        payload = pickle.dumps((op, chat_id, self._touched.get(chat_id, time.time()), value),
+                               protocol=pickle.HIGHEST_PROTOCOL)
+        self._log.write(_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self._records += 1
+        if self._records >= self.compact_every:
+            self.compact()
+
+    #################################################################
+    #                            EXPIRY                             #
+    #################################################################
+    def expire(self, now: Optional[float] = None) -> int:
+        """ Drop conversations idle for longer than `ttl`. Returns how many were dropped.
+        """
+        now = time.time() if now is None else now
+        stale = [chat_id for chat_id, touched in self._touched.items() if touched + self.ttl <= now]
+        for chat_id in stale:
+            del self[chat_id]
+        self.expired += len(stale)
+        return len(stale)
+
+    async def start(self, interval: float = 60):
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                self.expire()
+        self._task = asyncio.create_task(run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.close()
+
+    def stats(self):
+        return {'conversations': len(self), 'journal_records': self._records, 'expired': self.expired}
@@ -0,0 +1,73 @@
+import asyncio
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from tg.sender import MAX_MESSAGE_LENGTH
+
+PLACEHOLDER = "Writing..."
+
+
+class MessageStream:
+    """ Shows text that is still being generated in a single Telegram message.
+
+        `send(text)` posts the placeholder right away and `edit(message, text)`
+        replaces its text. While chunks arrive, at most one edit is in flight
+        and edits are at least `min_interval` seconds apart. Whatever arrived
+        in between goes out with the next edit, so a slow chat sees fewer,
+        bigger updates instead of a growing backlog. The last edit always
+        carries the full text.
+    """
+    def __init__(self, send: Callable[[str], Awaitable], edit: Callable[[object, str], Awaitable],
+                 min_interval: float = 1.0, placeholder: str = PLACEHOLDER):
+        self.send = send
+        self.edit = edit
+        self.min_interval = min_interval
+        self.placeholder = placeholder
+        self.message = None
+        self.text = ''
+        self.shown = ''
+        self.edits = 0
+        self.first_content_seconds: Optional[float] = None
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._started = 0.0
+
+    async def run(self, chunks: AsyncIterator[str]) -> str:
+        """ Stream `chunks` into the message and return the full text
+        """
+        self._started = time.perf_counter()
+        self.message = await self.send(self.placeholder)
+        editor = asyncio.create_task(self._edit_loop())
+        try:
+            async for chunk in chunks:
+                self.text += chunk
+                self._changed.set()
+        finally:
+            self._finished.set()
+            self._changed.set()
+            await editor
+        return self.text
+
+    async def _edit_loop(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            text = self.text.strip()[:MAX_MESSAGE_LENGTH]
+            if text and text != self.shown:
+                try:
+                    await self.edit(self.message, text)
+                    self.shown = text
+                    self.edits += 1
+                    if self.first_content_seconds is None:
+                        self.first_content_seconds = time.perf_counter() - self._started
+                except Exception as e:
+                    print(f"An error occured: {e}")
+            if self._finished.is_set():
+                if not self._changed.is_set():
+                    return
+                continue
+            # The final edit does not wait out the interval
+            try:
+                await asyncio.wait_for(self._finished.wait(), self.min_interval)
+            except asyncio.TimeoutError:
+                pass
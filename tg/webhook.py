@@ -0,0 +1,165 @@
+""" Webhook ingestion.
+
+    The front process accepts Telegram's POSTs with aiohttp and hands every
+    update to one of N worker processes, picked by hashing its chat_id, so all
+    updates of a chat are handled by the same worker and its in-memory
+    chat_states. With 0 workers updates are handled in the front process.
+
+    Requests without the secret token given to set_webhook are refused.
+
+    Replay a file of updates (one JSON update per line) against a local server:
+        python -m tg.webhook http://127.0.0.1:8443/webhook updates.jsonl <secret token>
+"""
+import asyncio
+import hmac
+import json
+import multiprocessing
+import queue
+import sys
+from typing import Awaitable, Callable, Dict, Iterable, List
+
+from aiohttp import web, ClientSession
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Update fields that carry a chat, in the order they are looked for
+CHAT_UPDATE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                      'my_chat_member', 'chat_member', 'chat_join_request')
+USER_UPDATE_FIELDS = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query',
+                      'poll_answer')
+
+
+def update_chat_id(update: Dict) -> int:
+    """ chat_id an update belongs to, falling back to the sender for updates without a chat
+    """
+    for field in CHAT_UPDATE_FIELDS:
+        if field in update:
+            return update[field]['chat']['id']
+    if 'callback_query' in update:
+        callback_query = update['callback_query']
+        if 'message' in callback_query:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for field in USER_UPDATE_FIELDS:
+        if field in update:
+            return update[field].get('from', update[field].get('user', {})).get('id', 0)
+    return 0
+
+
+def shard_for(chat_id: int, shard_count: int) -> int:
+    return chat_id % shard_count
+
+
+#################################################################
+#                          WORKERS                              #
+#################################################################
+class ShardedDispatcher:
+    """ Forwards raw update JSON to `shard_count` worker processes over bounded queues.
+
+        `worker_target(index, shard_count, queue)` runs in each spawned process and is
+        expected to call `serve_queue()`.
+    """
+    def __init__(self, worker_target: Callable, shard_count: int, queue_size: int = 1000):
+        self.worker_target = worker_target
+        self.shard_count = shard_count
+        context = multiprocessing.get_context('spawn')
+        self.queues = [context.Queue(queue_size) for _ in range(shard_count)]
+        self.processes = [context.Process(target=worker_target, args=(index, shard_count, self.queues[index]), daemon=True)
+                          for index in range(shard_count)]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def stop(self):
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+
+    def dispatch(self, chat_id: int, raw: str) -> bool:
+        """ False when the worker's queue is full
+        """
+        try:
+            self.queues[shard_for(chat_id, self.shard_count)].put_nowait(raw)
+            return True
+        except queue.Full:
+            return False
+
+
+async def serve_queue(worker_queue, handle: Callable[[str], Awaitable[None]]):
+    """ Worker side: feed every raw update from the queue to `handle` until a None arrives
+    """
+    loop = asyncio.get_running_loop()
+    pending = set()
+    while True:
+        raw = await loop.run_in_executor(None, worker_queue.get)
+        if raw is None:
+            break
+        task = asyncio.create_task(handle(raw))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+#################################################################
+#                            APP                                #
+#################################################################
+def make_app(path: str, accept: Callable[[int, str], Awaitable[bool]], secret_token: str) -> web.Application:
+    """ aiohttp app answering Telegram's webhook POSTs on `path`, when they carry `secret_token`.
+        `accept(chat_id, raw)` returns False to ask Telegram to retry later.
+    """
+    if not secret_token:
+        raise ValueError("A webhook needs a secret token")
+
+    async def handle_update(request: web.Request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret_token):
+            return web.Response(status=403)
+        raw = await request.text()
+        try:
+            chat_id = update_chat_id(json.loads(raw))
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        if not await accept(chat_id, raw):
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+async def start_app(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+#################################################################
+#                       REPLAY CLIENT                           #
+#################################################################
+async def replay(url: str, updates: Iterable[str], secret_token: str, concurrency: int = 50) -> List[int]:
+    """ POST raw updates to a running webhook, returns the response statuses in order
+    """
+    headers = {'Content-Type': 'application/json', SECRET_HEADER: secret_token}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with ClientSession(headers=headers) as session:
+        async def post(raw):
+            async with semaphore:
+                async with session.post(url, data=raw) as response:
+                    return response.status
+
+        return await asyncio.gather(*(post(raw) for raw in updates))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print("Usage: python -m tg.webhook <webhook url> <updates.jsonl> <secret token>")
+        sys.exit(1)
+    with open(sys.argv[2]) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    statuses = asyncio.run(replay(sys.argv[1], lines, sys.argv[3]))
+    print({status: statuses.count(status) for status in set(statuses)})